@@ -0,0 +1,310 @@
+# coding=utf-8
+'''
+CPU benchmarks of EDEE on synthetic documents of increasing length.
+
+    python benchmark.py quantization --lengths 100 200 400
+    python benchmark.py onnxruntime --lengths 100 200 400
+    python benchmark.py output_head --lengths 100 200 400
+    python benchmark.py window_coverage --windows 0 1 2 4 8
+    python benchmark.py neg_sampling --lengths 100 200 400 --num_neg_samples 2000
+    python benchmark.py neg_sampling_f1 --num_train_epochs 10 --num_neg_samples 2000
+    python benchmark.py encoder --lengths 250 500 1000 2000 4000
+'''
+import ctypes
+import gc
+import io
+import logging
+import time
+import torch
+
+from models import EDEE
+from run import build_parser, set_seed
+
+logger = logging.getLogger()
+
+
+def make_document(num_words,vocab_size,word_type_tag_num):
+    word_ids = torch.randint(1, vocab_size, (num_words,))
+    wType_ids = torch.randint(0, word_type_tag_num, (num_words,))
+    return word_ids,wType_ids
+
+
+def make_pair_labels(num_words,role_role_num):
+    # about 1% connected pairs, in line with ChFinAnn documents
+    num_pairs = num_words * num_words
+    return torch.where(torch.rand(num_pairs) < 0.01, torch.randint(1, role_role_num, (num_pairs,)),
+                       torch.zeros(num_pairs, dtype=torch.long))
+
+
+def time_forward(model,document,repeats):
+    '''
+    Median wall time in milliseconds of an inference forward pass.
+    '''
+    word_ids, wType_ids = document
+    timings = []
+    with torch.no_grad():
+        model(word_ids, wType_ids)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(word_ids, wType_ids)
+            timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2**20
+
+
+def proc_status_mb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 2**10
+
+
+def peak_memory_mb(fn):
+    '''
+    Peak memory in MB that one call of fn adds on top of the resident set of the process. Freed heap pages are
+    returned to the OS and the peak RSS is reset before the call (Linux only), so models and lengths
+    benchmarked earlier do not leak into the number.
+    '''
+    gc.collect()
+    ctypes.CDLL(None).malloc_trim(0)
+    baseline = proc_status_mb('VmRSS')
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    fn()
+    return proc_status_mb('VmHWM') - baseline
+
+
+def build_random_model(args):
+    args.token_embedding = torch.randn(args.vocab_size, args.word_embedding_dim)
+    model = EDEE(args, args.word_type_tag_num)
+    return model.eval()
+
+
+def bench_quantization(args):
+    from quantization import quantize_model
+
+    model = build_random_model(args)
+    models = [('fp32', model)] + [('int8+emb_' + dtype, quantize_model(model, dtype)) for dtype in ['fp32', 'fp16', 'int8']]
+    for name, m in models:
+        logger.info('%s model size: %.1f MB', name, model_size_mb(m))
+    for num_words in args.lengths:
+        document = make_document(num_words, args.vocab_size, args.word_type_tag_num)
+        for name, m in models:
+            forward_ms = time_forward(m, document, args.repeats)
+            with torch.no_grad():
+                forward_mb = peak_memory_mb(lambda: m(*document))
+            logger.info('words=%d %s: %.1f ms, peak memory +%.0f MB', num_words, name, forward_ms, forward_mb)
+
+
+def bench_onnxruntime(args):
+    import os
+    import tempfile
+    from export import export_onnx, onnx_session, run_onnx
+
+    model = build_random_model(args)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        onnx_path = os.path.join(tmp_dir, 'edee.onnx')
+        export_onnx(model, onnx_path, make_document(16, args.vocab_size, args.word_type_tag_num))
+        session = onnx_session(onnx_path, args.num_threads)
+        for num_words in args.lengths:
+            document = make_document(num_words, args.vocab_size, args.word_type_tag_num)
+            eager_ms = time_forward(model, document, args.repeats)
+            run_onnx(session, document)
+            timings = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                run_onnx(session, document)
+                timings.append((time.perf_counter() - start) * 1000)
+            onnx_ms = sorted(timings)[len(timings) // 2]
+            logger.info('words=%d eager: %.1f ms, onnxruntime: %.1f ms, speedup %.2fx',
+                        num_words, eager_ms, onnx_ms, eager_ms / onnx_ms)
+
+
+def time_call(fn,repeats):
+    fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def bench_output_head(args):
+    '''
+    Training step (pair_loss) and decoding (predict_pairs) of the pair head on the fcs output, the paths
+    trainer.py and server.py use. The factorized head computes only its factor logits per pair.
+    '''
+    models = []
+    for output_head in ['flat', 'factorized']:
+        args.output_head = output_head
+        model = build_random_model(args)
+        num_params = sum(p.numel() for p in model.fc_final.parameters())
+        width = model.fc_final.out_features if output_head == 'flat' else model.fc_final.fc.out_features
+        logger.info('%s head: %d parameters in fc_final, %d logits per pair', output_head, num_params, width)
+        models.append((output_head, model))
+
+    for num_words in args.lengths:
+        ent_ent_feature = torch.randn(num_words * num_words, 4 * args.hidden_size)
+        labels = make_pair_labels(num_words, args.role_role_num)
+        labels_weight = torch.ones(args.role_role_num)
+        for output_head, model in models:
+            def train_step():
+                model.zero_grad()
+                model.pair_loss(model.fcs(ent_ent_feature), labels, labels_weight).backward()
+            def predict():
+                with torch.no_grad():
+                    model.predict_pairs(model.fcs(ent_ent_feature))
+            train_ms = time_call(train_step, args.repeats)
+            train_mb = peak_memory_mb(train_step)
+            predict_ms = time_call(predict, args.repeats)
+            predict_mb = peak_memory_mb(predict)
+            logger.info('words=%d %s: train step %.1f ms, peak memory +%.0f MB, predict %.1f ms, peak memory +%.0f MB',
+                        num_words, output_head, train_ms, train_mb, predict_ms, predict_mb)
+
+
+def bench_window_coverage(args):
+    '''
+    Share of pairs scored and of labeled pairs kept by the sentence window, on the cached train examples.
+    '''
+    import os
+    import pickle
+    import numpy as np
+    from datasets import get_sent_ids, get_window_pair_ids
+
+    with open(os.path.join(args.cache_dir, 'train_example.pkl'), 'rb') as f:
+        examples = pickle.load(f)
+    for sent_window in args.windows:
+        num_pairs = num_scored = num_conn = num_conn_kept = 0
+        for example in examples:
+            labels = np.asarray(example['role_role_adj'])
+            pair_ids = get_window_pair_ids(get_sent_ids(example), example['word_types'],
+                                           sent_window, args.max_global_tokens)
+            num_pairs += len(labels)
+            num_scored += len(pair_ids)
+            num_conn += int((labels > 0).sum())
+            num_conn_kept += int((labels[pair_ids] > 0).sum())
+        logger.info('sent_window=%d: scored pairs %.4f, label recall %.4f (%d/%d connected pairs)', sent_window,
+                    num_scored / max(num_pairs, 1), num_conn_kept / max(num_conn, 1), num_conn_kept, num_conn)
+
+
+def bench_neg_sampling(args):
+    '''
+    Training steps per second with the full pair grid and with sampled non_conn pairs, both through the
+    losses trainer.train uses.
+    '''
+    from trainer import sampled_pair_loss
+
+    model = build_random_model(args).train()
+    labels_weight = torch.ones(args.role_role_num)
+    generator = torch.Generator().manual_seed(args.seed)
+    for num_words in args.lengths:
+        word_ids, wType_ids = make_document(num_words, args.vocab_size, args.word_type_tag_num)
+        inputs = {'word_ids': word_ids, 'wType_ids': wType_ids}
+        labels = make_pair_labels(num_words, args.role_role_num)
+        for neg_sampling in ['none', 'random', 'hard']:
+            args.neg_sampling = neg_sampling
+            def train_step():
+                model.zero_grad()
+                if neg_sampling == 'none':
+                    loss = model.pair_loss(model.pair_features(model.encode(word_ids, wType_ids)), labels, labels_weight)
+                else:
+                    loss = sampled_pair_loss(args, model, inputs, labels, labels_weight, generator)
+                loss.backward()
+            step_ms = time_call(train_step, args.repeats)
+            step_mb = peak_memory_mb(train_step)
+            logger.info('words=%d neg_sampling=%s: %.1f ms/step, %.2f steps/s, peak memory +%.0f MB',
+                        num_words, neg_sampling, step_ms, 1000 / step_ms, step_mb)
+
+
+def bench_neg_sampling_f1(args):
+    '''
+    Train with the full pair grid and with random and hard sampled non_conn pairs on the cached datasets,
+    reporting training steps per second next to the best dev macro F1. The time of the dev evaluation
+    that train runs after every epoch is measured separately and left out of the steps per second.
+    '''
+    import os
+    from datasets import load_datasets_and_vocabs
+    from trainer import train, evaluate, get_macro_f1
+
+    train_dataset,train_labels_weight,dev_dataset,dev_labels_weight,_,_,_,wType_tag_vocab = load_datasets_and_vocabs(args)
+    output_dir = args.output_dir
+    rows = []
+    for neg_sampling in ['none', 'random', 'hard']:
+        args.neg_sampling = neg_sampling
+        args.output_dir = os.path.join(output_dir, 'neg_sampling_' + neg_sampling)
+        args.tb_log_dir = os.path.join(args.output_dir, 'runs')
+        set_seed(args)
+        model = EDEE(args, wType_tag_vocab['len']).to(args.device)
+        start = time.perf_counter()
+        dev_history = train(args, model, train_dataset, dev_dataset, None,
+                            train_labels_weight, dev_labels_weight, None)
+        total_seconds = time.perf_counter() - start
+
+        with open(os.devnull, 'w') as f:
+            start = time.perf_counter()
+            evaluate(args, dev_dataset, model, torch.as_tensor(dev_labels_weight).to(args.device), f)
+            eval_seconds = time.perf_counter() - start
+        train_seconds = total_seconds - len(dev_history) * eval_seconds
+        dev_f1 = [get_macro_f1(results) for results in dev_history]
+        best_epoch = max(range(len(dev_f1)), key=lambda epoch: dev_f1[epoch])
+        rows.append((neg_sampling, len(dev_history) * len(train_dataset) / train_seconds, dev_f1[best_epoch], best_epoch + 1))
+    args.output_dir = output_dir
+
+    for neg_sampling, steps_per_second, dev_f1, best_epoch in rows:
+        logger.info('neg_sampling=%s: %.2f train steps/s, best dev macro f1 %.4f (epoch %d)',
+                    neg_sampling, steps_per_second, dev_f1, best_epoch)
+
+
+def bench_encoder(args):
+    models = []
+    for encoder in ['bilstm', 'transformer', 'dilated_cnn']:
+        args.encoder = encoder
+        model = build_random_model(args)
+        num_params = sum(p.numel() for p in model.token_encoder.parameters())
+        logger.info('%s encoder: %d parameters', encoder, num_params)
+        models.append((encoder, model))
+    for num_words in args.lengths:
+        word_ids, wType_ids = make_document(num_words, args.vocab_size, args.word_type_tag_num)
+        for encoder, model in models:
+            with torch.no_grad():
+                encode_ms = time_call(lambda: model.encode(word_ids, wType_ids), args.repeats)
+            logger.info('words=%d %s: %.1f ms', num_words, encoder, encode_ms)
+
+
+BENCHMARKS = {'quantization': bench_quantization,
+              'onnxruntime': bench_onnxruntime,
+              'output_head': bench_output_head,
+              'window_coverage': bench_window_coverage,
+              'neg_sampling': bench_neg_sampling,
+              'neg_sampling_f1': bench_neg_sampling_f1,
+              'encoder': bench_encoder}
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',level=logging.INFO)
+    parser = build_parser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--lengths', type=int, nargs='+', default=[100, 200, 400], help='Document lengths in words.')
+    parser.add_argument('--repeats', type=int, default=5, help='Timed forward passes per document.')
+    parser.add_argument('--vocab_size', type=int, default=20000, help='Rows of the random word embedding.')
+    parser.add_argument('--word_type_tag_num', type=int, default=20, help='Number of word type tags.')
+    parser.add_argument('--num_threads', type=int, default=1, help='torch intra-op threads.')
+    parser.add_argument('--windows', type=int, nargs='+', default=[0, 1, 2, 4, 8],
+                        help='Sentence windows reported by window_coverage.')
+    args = parser.parse_args()
+    args.device = torch.device('cpu')
+    torch.set_num_threads(args.num_threads)
+    set_seed(args)
+
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,101 +1,290 @@
+# coding=utf-8
+'''
+将无标注的HTML文件批量转换为create_example可读取的json lines文件, 每行一个 [doc_id, doc]。
+zero-shot事件类型不属于ChFinAnn的event_roles, create_example会跳过这些事件, 把文档读成没有事件的文档。
+
+    python data/data_pre.py --input_dir ./no_tag_html --output_file ./data/no_tag.jsonl --num_workers 4
+    python data/data_pre.py --input_dir ./no_tag_html --output_file ./data/no_tag.jsonl --backend stub --check
+
+中断后以相同参数重新运行即可续跑, 已写入的文档会被跳过。--check需要在仓库根目录运行 (datasets读取./data/stopwords.txt)。
+'''
+import argparse
+import json
+import logging
 import os
 import re
-import spacy
-from transformers import pipeline
+import sys
+from multiprocessing import Pool
 from bs4 import BeautifulSoup
 
-# 加载spaCy中文模型
-nlp = spacy.load('zh_core_web_sm')
+logger = logging.getLogger(__name__)
+
+CANDIDATE_LABELS = ["危险化学品信息", "应急处理", "健康危害", "环境危害"]
+
+
+class SpacyBackend(object):
+    '''
+    spaCy中文模型, 一次nlp.pipe同时完成分句和NER。
+    '''
+    def __init__(self, model='zh_core_web_sm', batch_size=16):
+        import spacy
+        self.nlp = spacy.load(model)
+        self.batch_size = batch_size
+
+    def analyze(self, texts):
+        results = []
+        for doc in self.nlp.pipe(texts, batch_size=self.batch_size):
+            sentences = []
+            entities = []
+            sent_ends = []
+            for sent in doc.sents:
+                # 句子去掉首尾空白后, 实体的字符偏移也要减去开头的空白
+                lead = len(sent.text) - len(sent.text.lstrip())
+                sentences.append((sent.start_char + lead, sent.text.strip()))
+                sent_ends.append(sent.end_char)
+            sent_idx = 0
+            for ent in doc.ents:
+                while sent_ends[sent_idx] <= ent.start_char:
+                    sent_idx += 1
+                start = ent.start_char - sentences[sent_idx][0]
+                entities.append((ent.text, ent.label_, sent_idx, start, start + len(ent.text)))
+            results.append(([sentence for _, sentence in sentences], entities))
+        return results
+
+
+class ZeroShotBackend(object):
+    '''
+    Hugging Face zero-shot-classification, 按批对句子进行事件类型分类。
+    '''
+    def __init__(self, model='facebook/bart-large-mnli', batch_size=32):
+        from transformers import pipeline
+        self.classifier = pipeline("zero-shot-classification", model=model)
+        self.batch_size = batch_size
+
+    def classify(self, sentences, candidate_labels):
+        if not sentences:
+            return []
+        results = self.classifier(sentences, candidate_labels=candidate_labels, batch_size=self.batch_size)
+        if isinstance(results, dict):
+            results = [results]
+        return [result['labels'][0] for result in results]
+
+
+class StubNLP(object):
+    '''
+    离线替身: 按中文标点分句, 用正则识别以公司/集团/有限公司结尾的机构名。
+    '''
+    sentence_pattern = re.compile(r'[^。！？；\n]+[。！？；]?')
+    entity_pattern = re.compile(r'[一-龥]{2,}?(?:有限公司|公司|集团)')
+
+    def __init__(self, model=None, batch_size=None):
+        pass
+
+    def analyze(self, texts):
+        results = []
+        for text in texts:
+            sentences = [m.group().strip() for m in self.sentence_pattern.finditer(text) if m.group().strip()]
+            entities = [(m.group(), 'ORG', sent_idx, m.start(), m.end())
+                        for sent_idx, sentence in enumerate(sentences)
+                        for m in self.entity_pattern.finditer(sentence)]
+            results.append((sentences, entities))
+        return results
+
+
+class StubClassifier(object):
+    '''
+    离线替身: 取句子中出现关键字最多的事件类型, 都没有出现时取第一个候选。
+    '''
+    keywords = {"危险化学品信息": ["成分", "化学品", "CAS", "理化"], "应急处理": ["急救", "泄漏", "灭火", "处置"],
+                "健康危害": ["吸入", "皮肤", "眼睛", "中毒"], "环境危害": ["环境", "水体", "土壤", "生态"]}
+
+    def __init__(self, model=None, batch_size=None):
+        pass
+
+    def classify(self, sentences, candidate_labels):
+        return [max(candidate_labels, key=lambda label: sum(k in sentence for k in self.keywords.get(label, [])))
+                for sentence in sentences]
+
+
+class StubLTP(object):
+    '''
+    离线替身: 按字切词, 词性都标为n, 供--check调用create_example。
+    '''
+    def seg(self, sentences):
+        words = [list(sentence) for sentence in sentences]
+        return words, words
+
+    def pos(self, hidden):
+        return [['n'] * len(words) for words in hidden]
+
+
+NLP_BACKENDS = {'spacy': SpacyBackend, 'stub': StubNLP}
+CLASSIFIER_BACKENDS = {'bart': ZeroShotBackend, 'stub': StubClassifier}
 
-# 使用Hugging Face Transformers进行事件提取
-event_model = pipeline("zero-shot-classification", model="facebook/bart-large-mnli")
+_nlp = None
+_classifier = None
+
+
+def init_worker(args):
+    global _nlp, _classifier
+    nlp_backend = 'stub' if args.backend == 'stub' else 'spacy'
+    classifier_backend = 'stub' if args.backend == 'stub' else 'bart'
+    _nlp = NLP_BACKENDS[nlp_backend](args.spacy_model, args.batch_size)
+    _classifier = CLASSIFIER_BACKENDS[classifier_backend](args.event_model, args.batch_size)
 
-# 设定文件目录
-directory = r'C:\Users\chan\Desktop\研究\危险品数据集相关\危化品数据集相关\no_tag_html'
 
 def process_text(text):
     # 删除“16. 其它信息”部分及之后的内容
     text = re.sub(r'16\.\s*其它信息[\s\S]*', '', text)
     return text
 
-def extract_sentences(text):
-    # 使用spaCy进行中文分句
-    doc = nlp(text)
-    sentences = [sent.text.strip() for sent in doc.sents]
-    return sentences
-
-def extract_entities(text):
-    # 使用spaCy进行NER识别
-    doc = nlp(text)
-    entities = {}
-    for ent in doc.ents:
-        entities[ent.text] = ent.label_
-    return entities
-
-def generate_events(sentences):
-    events = []
-    for i, sentence in enumerate(sentences):
-        # 使用Transformers的zero-shot-classification来识别事件类型
-        result = event_model(sentence, candidate_labels=["危险化学品信息", "应急处理", "健康危害", "环境危害"])
-        event_type = result['labels'][0]  # 获取最可能的事件类型
-        events.append({
-            "recguid": str(i + 1),
-            "event_type": event_type,
-            "arguments": {
-                "sentence": sentence
-            }
-        })
-    return events
-
-def generate_data_structure(file_path):
-    # 读取HTML文件内容
+
+def read_text(file_path):
+    # 读取HTML文件内容, 使用BeautifulSoup解析
     with open(file_path, 'r', encoding='utf-8') as file:
         html_content = file.read()
-
-    # 使用BeautifulSoup解析HTML
     soup = BeautifulSoup(html_content, 'html.parser')
-    text_content = soup.get_text()
+    return process_text(soup.get_text())
 
-    # 处理文本，删除不需要的部分
-    cleaned_text = process_text(text_content)
 
-    # 提取句子
-    sentences = extract_sentences(cleaned_text)
+def build_doc(sentences, entities, event_types):
+    # 事件格式与ChFinAnn一致: [recguid, event_type, arguments]
+    events = [[str(i + 1), event_type, {"sentence": sentence}]
+              for i, (sentence, event_type) in enumerate(zip(sentences, event_types))]
 
-    # 提取实体
-    entities = extract_entities(cleaned_text)
+    # 实体范围 (ann_mspan2dranges) 与实体类型 (ann_mspan2guess_field)
+    ann_mspan2dranges = {}
+    ann_mspan2guess_field = {}
+    for text, label, sent_idx, start, end in entities:
+        dranges = ann_mspan2dranges.setdefault(text, [])
+        if [sent_idx, start, end] not in dranges:
+            dranges.append([sent_idx, start, end])
+        ann_mspan2guess_field[text] = "Chemical" if label == "ORG" else "Location"
 
-    # 提取事件
-    events = generate_events(sentences)
+    return {
+        "sentences": sentences,
+        "ann_valid_mspans": list(ann_mspan2dranges),
+        "recguid_eventname_eventdict_list": events,
+        "ann_mspan2dranges": ann_mspan2dranges,
+        "ann_mspan2guess_field": ann_mspan2guess_field
+    }
 
-    # 获取实体范围 (ann_mspan2dranges)
-    ann_mspan2dranges = {}
-    for ent in entities:
-        ann_mspan2dranges[ent] = [(sentences.index(sentence), sentence.find(ent), sentence.find(ent) + len(ent))
-                                  for sentence in sentences if ent in sentence]
-
-    # 推断实体类型 (ann_mspan2guess_field)
-    ann_mspan2guess_field = {ent: "Chemical" if label == "ORG" else "Location" for ent, label in entities.items()}
-
-    # 构建最终的数据结构
-    doc_structure = [{
-        "doc_1": {
-            "sentences": sentences,
-            "recguid_eventname_eventdict_list": events,
-            "ann_mspan2dranges": ann_mspan2dranges,
-            "ann_mspan2guess_field": ann_mspan2guess_field
-        }
-    }]
-
-    return doc_structure
-
-# 遍历目录中的HTML文件并处理
-all_docs = []
-for filename in os.listdir(directory):
-    if filename.endswith('.html'):
-        file_path = os.path.join(directory, filename)
-        doc_structure = generate_data_structure(file_path)
-        all_docs.extend(doc_structure)
-
-# 输出处理后的数据结构
-print(all_docs)
+
+def convert_files(file_paths):
+    '''
+    转换一批HTML文件: 一次nlp.pipe, 一次批量zero-shot分类。返回 [(doc_id, doc 或 None, 错误信息)]。
+    '''
+    results = []
+    texts = []
+    for file_path in file_paths:
+        doc_id = os.path.splitext(os.path.basename(file_path))[0]
+        try:
+            texts.append((doc_id, read_text(file_path)))
+        except Exception as e:
+            results.append((doc_id, None, repr(e)))
+
+    analyzed = _nlp.analyze([text for _, text in texts])
+    all_sentences = [sentence for sentences, _ in analyzed for sentence in sentences]
+    all_event_types = _classifier.classify(all_sentences, CANDIDATE_LABELS)
+
+    offset = 0
+    for (doc_id, _), (sentences, entities) in zip(texts, analyzed):
+        event_types = all_event_types[offset:offset + len(sentences)]
+        offset += len(sentences)
+        results.append((doc_id, build_doc(sentences, entities, event_types), None))
+    return results
+
+
+def load_finished(output_file):
+    '''
+    读取已写入的文档id, 并截掉崩溃时写了一半的最后一行。
+    '''
+    finished = set()
+    if not os.path.exists(output_file):
+        return finished
+    valid_bytes = 0
+    with open(output_file, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                doc_id, _ = json.loads(line.decode('utf-8'))
+            except ValueError:
+                break
+            finished.add(doc_id)
+            valid_bytes += len(line)
+    if valid_bytes < os.path.getsize(output_file):
+        logger.info('Truncating incomplete tail of %s', output_file)
+        with open(output_file, 'r+b') as f:
+            f.truncate(valid_bytes)
+    return finished
+
+
+def check_output(args):
+    '''
+    用datasets.create_example读取输出文件, 确认训练与推理代码可以直接使用。
+    '''
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from datasets import create_example
+    if args.backend == 'stub':
+        ltp = StubLTP()
+    else:
+        from ltp import LTP
+        ltp = LTP()
+    examples, _ = create_example(args.output_file, ltp)
+    logger.info('create_example read %d documents, %d words from %s', len(examples),
+                sum(len(example['words']) for example in examples), args.output_file)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_dir', type=str, required=True, help='Directory of the html files.')
+    parser.add_argument('--output_file', type=str, required=True, help='Json lines file to write.')
+    parser.add_argument('--backend', type=str, default='model', choices=['model', 'stub'],
+                        help='model: spaCy + zero-shot BART. stub: offline regex/keyword stand-ins.')
+    parser.add_argument('--spacy_model', type=str, default='zh_core_web_sm')
+    parser.add_argument('--event_model', type=str, default='facebook/bart-large-mnli')
+    parser.add_argument('--num_workers', type=int, default=1, help='Worker processes, each loads its own models.')
+    parser.add_argument('--files_per_task', type=int, default=8, help='Files analyzed together by a worker.')
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size of nlp.pipe and the zero-shot pipeline.')
+    parser.add_argument('--check', action='store_true', help='Read the output file with datasets.create_example afterwards.')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', level=logging.INFO)
+    args = parse_args()
+
+    finished = load_finished(args.output_file)
+    file_paths = sorted(os.path.join(args.input_dir, filename) for filename in os.listdir(args.input_dir)
+                        if filename.endswith('.html') and os.path.splitext(filename)[0] not in finished)
+    logger.info('%d files done, %d files to convert', len(finished), len(file_paths))
+    tasks = [file_paths[i:i + args.files_per_task] for i in range(0, len(file_paths), args.files_per_task)]
+
+    num_done = 0
+    with open(args.output_file, 'a', encoding='utf-8') as fout:
+        if args.num_workers > 1:
+            pool = Pool(args.num_workers, initializer=init_worker, initargs=(args,))
+            results = pool.imap_unordered(convert_files, tasks)
+        else:
+            pool = None
+            init_worker(args)
+            results = map(convert_files, tasks)
+        for task_results in results:
+            for doc_id, doc, error in task_results:
+                if doc is None:
+                    logger.warning('Failed to convert %s: %s', doc_id, error)
+                    continue
+                fout.write(json.dumps([doc_id, doc], ensure_ascii=False) + '\n')
+                num_done += 1
+            fout.flush()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    logger.info('Converted %d files into %s', num_done, args.output_file)
+    if args.check:
+        check_output(args)
+
+
+if __name__ == "__main__":
+    main()
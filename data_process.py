@@ -39,6 +39,45 @@ def get_role_role2idx():
 
     return role_role2idx,idx2role_role
 
+def get_role_role_table():
+    '''
+    Per event type, the index of each of its B_/I_ roles and a table whose entry [i][j] is the
+    role_role2idx label of (event_type, roles[i], roles[j]).
+    '''
+    role_role2idx,_ = get_role_role2idx()
+    event_role2idx = {}
+    role_role_tables = {}
+    for event_type,roles in event_roles.items():
+        event_role2idx[event_type] = {role:idx for idx,role in enumerate(roles)}
+        role_role_tables[event_type] = [[role_role2idx[(event_type,role1,role2)] for role2 in roles] for role1 in roles]
+    return event_role2idx,role_role_tables
+
+def get_role_tag2idx():
+    '''
+    Index of every B_/I_ role tag over all event types, in the order of first appearance in event_roles.
+    '''
+    role_tag2idx = {}
+    for event_type,roles in event_roles.items():
+        for role in roles:
+            if role not in role_tag2idx:
+                role_tag2idx[role] = len(role_tag2idx)
+    return role_tag2idx
+
+def get_factorized_role_role_index():
+    '''
+    Split every connected label of role_role2idx into (event type, role tag, role tag) indices.
+    Label i+1 of role_role2idx is (event_types[i], role1_tags[i], role2_tags[i]).
+    '''
+    role_role2idx,idx2role_role = get_role_role2idx()
+    role_tag2idx = get_role_tag2idx()
+    event_types, role1_tags, role2_tags = [], [], []
+    for idx in range(1,len(idx2role_role)):
+        event_type,role1,role2 = idx2role_role[idx]
+        event_types.append(event_type2idx[event_type])
+        role1_tags.append(role_tag2idx[role1])
+        role2_tags.append(role_tag2idx[role2])
+    return event_types,role1_tags,role2_tags
+
 def get_stop_words():
     stopwords = []
     with open('./data/stopwords.txt', 'r', encoding='utf-8') as f_stopword:
@@ -13,6 +13,8 @@ from bert_serving.client import BertClient
 logger = logging.getLogger(__name__)
 
 role_role2idx,idx2role_role = get_role_role2idx()
+event_role2idx,role_role_tables = get_role_role_table()
+role_role_tables = {event_type:torch.tensor(table) for event_type,table in role_role_tables.items()}
 stopwords = get_stop_words()
 
 
@@ -83,27 +85,113 @@ def load_datasets_and_vocabs(args):
         with open(test_weight_file,'w') as wf:
             json.dump(test_labels_weight,wf)
 
+        logger.info('Creating label_count_caches')
+        for split,examples in [('train',train_examples),('dev',dev_examples),('test',test_examples)]:
+            with open(os.path.join(args.cache_dir, '{}_count_catch.txt'.format(split)),'w') as wf:
+                json.dump(count_labels(examples),wf)
+
+    appended_examples = []
+    if getattr(args, 'append_file', None):
+        split_examples = {'train':train_examples,'dev':dev_examples,'test':test_examples}
+        appended_examples,labels_weight = append_and_cache_examples(args,args.append_split,split_examples[args.append_split])
+        if labels_weight is not None:
+            if args.append_split == 'train':
+                train_labels_weight = labels_weight
+            elif args.append_split == 'dev':
+                dev_labels_weight = labels_weight
+            else:
+                test_labels_weight = labels_weight
+
     logger.info('Train set size: %s', len(train_examples))
     logger.info('Dev set size: %s', len(dev_examples))
     logger.info('Test set size: %s,', len(test_examples))
 
     # Build word vocabulary(dep_tag, part of speech) and save pickles.
-    word_vecs,word_vocab,wType_tag_vocab = load_and_cache_vocabs(train_examples+dev_examples+test_examples, args)
+    word_vecs,word_vocab,wType_tag_vocab = load_and_cache_vocabs(train_examples+dev_examples+test_examples, args, appended_examples)
 
     embedding = torch.from_numpy(np.asarray(word_vecs, dtype=np.float32))
     args.token_embedding = embedding
 
+    if getattr(args, 'max_doc_words', 0) > 0:
+        train_examples = split_overlong_examples(train_examples,args.max_doc_words,args.window_overlap_sents)
+        dev_examples = split_overlong_examples(dev_examples,args.max_doc_words,args.window_overlap_sents)
+        test_examples = split_overlong_examples(test_examples,args.max_doc_words,args.window_overlap_sents)
+        logger.info('Windows of at most %s words: train %s, dev %s, test %s', args.max_doc_words,
+                    len(train_examples), len(dev_examples), len(test_examples))
+
     train_dataset = ED_Dataset(train_examples,args,word_vocab,wType_tag_vocab)
     dev_dataset = ED_Dataset(dev_examples,args,word_vocab,wType_tag_vocab)
     test_dataset = ED_Dataset(test_examples,args,word_vocab,wType_tag_vocab)
 
     return train_dataset,train_labels_weight,dev_dataset,dev_labels_weight,test_dataset,test_labels_weight,word_vocab,wType_tag_vocab
 
-def generate_user_dict(files,path):
-    f = open(path, 'w', encoding='utf-8')
+def append_and_cache_examples(args,split,examples):
+    '''
+    Preprocess only the documents of args.append_file and append them to the cached examples of a split.
+    Label counts are updated incrementally, so the class weights never need the old documents re-tokenized.
+    '''
+    example_file = os.path.join(args.cache_dir, '{}_example.pkl'.format(split))
+    weight_file = os.path.join(args.cache_dir, '{}_weight_catch.txt'.format(split))
+    count_file = os.path.join(args.cache_dir, '{}_count_catch.txt'.format(split))
+    manifest_file = os.path.join(args.cache_dir, 'appended_files.json')
+
+    manifest = []
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    append_key = [split, os.path.abspath(args.append_file)]
+    if append_key in manifest:
+        logger.info('%s has already been appended to %s examples, skipping', args.append_file, split)
+        return [],None
+
+    if os.path.exists(count_file):
+        with open(count_file, 'r') as f:
+            label_counts = json.load(f)
+    else:
+        # caches written before incremental ingestion only hold weights, recount from the cached labels
+        logger.info('Counting %s labels from cached examples', split)
+        label_counts = count_labels(examples)
+
+    logger.info('Loading ltp tool')
+    ltp = LTP()
+    user_dict_file = os.path.join(args.dataset_path,'company.txt')
+    generate_user_dict([args.append_file],user_dict_file,mode='a')
+    ltp.init_dict(path=user_dict_file)
+
+    logger.info('Creating %s examples from %s', split, args.append_file)
+    new_examples,_ = create_example(args.append_file,ltp)
+    examples.extend(new_examples)
+    for label,num in enumerate(count_labels(new_examples)):
+        label_counts[label] += num
+    labels_weight = get_labels_weight_from_counts(label_counts)
+
+    logger.info('Appended %s examples, store %s examples to cache file', len(new_examples), split)
+    with open(example_file, 'wb') as f:
+        pickle.dump(examples, f, -1)
+    with open(weight_file,'w') as wf:
+        json.dump(labels_weight,wf)
+    with open(count_file,'w') as wf:
+        json.dump(label_counts,wf)
+
+    manifest.append(append_key)
+    with open(manifest_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+    return new_examples,torch.Tensor(labels_weight)
+
+def load_docs(file):
+    '''
+    Documents of a ChFinAnn style json file, or of a json lines file with one [doc_id, doc] per line.
+    '''
+    with open(file, 'r', encoding='utf-8-sig') as fp:
+        if file.endswith('.jsonl'):
+            return [json.loads(line) for line in fp if line.strip()]
+        return json.load(fp)
+
+def generate_user_dict(files,path,mode='w'):
+    f = open(path, mode, encoding='utf-8')
     for file in files:
-        with open(file, 'r', encoding='utf-8-sig') as fp:
-            datas = json.load(fp)
+        datas = load_docs(file)
 
         for doc in datas:
             entities = doc[1]['ann_valid_mspans']
@@ -112,14 +200,14 @@ def generate_user_dict(files,path):
     f.close()
 
 def create_example(file,ltp):
-    with open(file, 'r', encoding='utf-8-sig') as fp:
-        datas = json.load(fp)
+    datas = load_docs(file)
 
     examples = []
     label_ids = []
+    unknown_event_types = Counter()
     for doc in datas:
         sentences = doc[1]['sentences']
-        events = doc[1]['recguid_eventname_eventdict_list']
+        events = filter_known_events(doc[1]['recguid_eventname_eventdict_list'], unknown_event_types)
         arg_dranges = doc[1]['ann_mspan2dranges']
         mspan2guess_field = doc[1]['ann_mspan2guess_field']
         word_info_dict = {}
@@ -163,37 +251,214 @@ def create_example(file,ltp):
                 word_id += 1
 
         arg_arg_adj = torch.zeros(len(all_words), len(all_words), requires_grad=False, dtype=torch.long)
-        for w_id1,etype1,e_id1,role1,loc_in_arg1 in valid_words:
-            for w_id2,etype2,e_id2,role2,loc_in_arg2 in valid_words:
-                if w_id1 == w_id2:
-                    continue
-                if (etype1 == etype2) and (e_id1 == e_id2):
-                    if loc_in_arg1 == 0:
-                        r1 = 'B_' + role1
-                    else:
-                        r1 = 'I_' + role1
-                    if loc_in_arg2 == 0:
-                        r2 = 'B_' + role2
-                    else:
-                        r2 = 'I_' + role2
-                    arg_arg_adj[w_id1][w_id2] = role_role2idx[(etype1,r1,r2)]
-
-        example = {'words': [], 'sens': [], 'word_types': []}
+        # words of the same event are connected pairwise, fill each event's block at once
+        event_words = defaultdict(list)
+        for w_id,etype,e_id,role,loc_in_arg in valid_words:
+            event_words[(etype,e_id)].append((w_id,role,loc_in_arg))
+        for (etype,e_id),words in event_words.items():
+            if len(words) < 2:
+                continue
+            w_ids = torch.tensor([w_id for w_id,_,_ in words])
+            role_ids = torch.tensor([event_role2idx[etype][('B_' if loc_in_arg == 0 else 'I_') + role]
+                                     for _,role,loc_in_arg in words])
+            arg_arg_adj[w_ids.unsqueeze(1), w_ids.unsqueeze(0)] = role_role_tables[etype][role_ids.unsqueeze(1), role_ids.unsqueeze(0)]
+        arg_arg_adj.fill_diagonal_(0)
+
+        example = {'words': [], 'sens': [], 'word_types': [], 'sent_ids': []}
         for sent_idx,word,word_type in all_words:
             example['words'].append(word)
             example['sens'].append(sentences[sent_idx])
             example['word_types'].append(word_type)
+            example['sent_ids'].append(sent_idx)
 
         example['role_role_adj'] = arg_arg_adj.reshape(-1).tolist()
         examples.append(example)
 
-        for line in arg_arg_adj.tolist():
-            for ele in line:
-                label_ids.append(ele)
+        label_ids.extend(example['role_role_adj'])
 
+    if unknown_event_types:
+        logger.warning('Skipped events of types outside event_roles in %s: %s', file, dict(unknown_event_types))
     label_weight = get_labels_weight(label_ids)
     return examples,label_weight
 
+def filter_known_events(events,unknown_event_types=None):
+    '''
+    Drop the events whose type, and the arguments whose role, are not in event_roles. Documents converted
+    by data/data_pre.py carry zero-shot event types outside the ChFinAnn label space and are read as
+    documents without events. Dropped event types are counted into unknown_event_types.
+    '''
+    known_events = []
+    for event_id,event_type,role_args in events:
+        if event_type not in event_role2idx:
+            if unknown_event_types is not None:
+                unknown_event_types[event_type] += 1
+            continue
+        role_args = {role:arg for role,arg in role_args.items() if 'B_' + role in event_role2idx[event_type]}
+        known_events.append([event_id,event_type,role_args])
+    return known_events
+
+def create_inference_example(sentences,ltp,mspan2guess_field=None,mspan2dranges=None):
+    '''
+    Segment an unlabeled document with the node layout of create_example: one node per distinct non-stopword,
+    five nodes for a word tagged nt/nh/nz/ni whose first character falls in a mention's character range.
+    Ranges come from mspan2dranges, or are found by exact matches of the mspan2guess_field mentions.
+    create_example gives the guessed field only to words contained in an event argument, which is unknown
+    here, so every mention is taken as an argument: the first node of a word inside a mention and contained
+    in its text takes the mention's guessed field, the other nodes are 'Other'.
+    '''
+    mspan2guess_field = mspan2guess_field or {}
+    if mspan2dranges is None:
+        mspan2dranges = find_mention_dranges(sentences, mspan2guess_field)
+    example = {'words': [], 'sens': [], 'word_types': [], 'sent_ids': []}
+    seen_words = set()
+    for sent_idx,sentence in enumerate(sentences):
+        if len(sentence.strip()) == 0:
+            continue
+        words, hidden = ltp.seg([sentence.strip()])
+        words = words[0]
+        pos = ltp.pos(hidden)[0]
+        word_loc = 0
+        for word_idx,word in enumerate(words):
+            word_types = ['Other']
+            for arg,dranges in mspan2dranges.items():
+                if any(sent == sent_idx and ch_s <= word_loc <= ch_e for sent,ch_s,ch_e in dranges):
+                    num_nodes = 5 if pos[word_idx] in ['nt', 'nh', 'nz', 'ni'] else 1
+                    word_type = mspan2guess_field.get(arg, 'Other') if word in arg else 'Other'
+                    word_types = [word_type] + ['Other'] * (num_nodes - 1)
+                    break
+            word_loc += len(word)
+            if word in seen_words or word in stopwords:
+                continue
+            seen_words.add(word)
+            for word_type in word_types:
+                example['words'].append(word)
+                example['sens'].append(sentence)
+                example['word_types'].append(word_type)
+                example['sent_ids'].append(sent_idx)
+    return example
+
+def find_mention_dranges(sentences,mentions):
+    '''
+    [sent_idx, start, end] of every exact occurrence of the mentions, in the format of ann_mspan2dranges.
+    '''
+    mspan2dranges = {}
+    for mention in mentions:
+        for sent_idx,sentence in enumerate(sentences):
+            sentence = sentence.strip()
+            start = sentence.find(mention)
+            while start >= 0:
+                mspan2dranges.setdefault(mention, []).append([sent_idx, start, start + len(mention)])
+                start = sentence.find(mention, start + 1)
+    return mspan2dranges
+
+def get_sent_ids(example):
+    '''
+    Sentence index of every word. Examples cached before sent_ids was stored only keep the sentence
+    text, so consecutive words of the same sentence text are numbered together.
+    '''
+    if 'sent_ids' in example:
+        return example['sent_ids']
+    sent_ids = []
+    for idx,sen in enumerate(example['sens']):
+        if idx == 0:
+            sent_ids.append(0)
+        else:
+            sent_ids.append(sent_ids[-1] + int(sen != example['sens'][idx-1]))
+    return sent_ids
+
+def get_window_pair_ids(sent_ids,word_types,sent_window,max_global_tokens=16):
+    '''
+    Flat ids i*N+j of the pairs whose words are at most sent_window sentences apart,
+    plus every pair involving one of the first max_global_tokens words typed other than 'Other'.
+    The number of pairs grows linearly with the document length for a fixed window.
+    '''
+    sent_ids = np.asarray(sent_ids)
+    num_words = len(sent_ids)
+    order = np.argsort(sent_ids, kind='stable')
+    sorted_sent_ids = sent_ids[order]
+    lo = np.searchsorted(sorted_sent_ids, sorted_sent_ids - sent_window, side='left')
+    hi = np.searchsorted(sorted_sent_ids, sorted_sent_ids + sent_window, side='right')
+    counts = hi - lo
+    rows = np.repeat(order, counts)
+    starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+    cols = order[np.arange(counts.sum()) + starts]
+    pair_ids = [rows * num_words + cols]
+
+    global_words = [idx for idx,word_type in enumerate(word_types) if word_type != 'Other'][:max_global_tokens]
+    if global_words:
+        global_words = np.asarray(global_words)
+        all_words = np.arange(num_words)
+        pair_ids.append((global_words[:, None] * num_words + all_words[None, :]).reshape(-1))
+        pair_ids.append((all_words[:, None] * num_words + global_words[None, :]).reshape(-1))
+    return np.unique(np.concatenate(pair_ids)).tolist()
+
+def split_overlong_examples(examples,max_words,overlap_sents):
+    '''
+    Split every example longer than max_words into overlapping sentence-aligned windows,
+    consecutive windows share overlap_sents sentences. Examples that fit are kept whole.
+    Every returned example carries doc_id, doc_len and word_offsets (its words' indices in the document),
+    labeled examples also carry doc_labels, the (pair id, label) of every connected pair of the document,
+    so predictions can be scored against the whole document after merge_window_predictions.
+    '''
+    windows = []
+    for doc_id,example in enumerate(examples):
+        num_words = len(example['words'])
+        doc_info = {'doc_id': doc_id, 'doc_len': num_words}
+        if 'role_role_adj' in example:
+            adj = torch.tensor(example['role_role_adj']).view(num_words, num_words)
+            conn = torch.nonzero(adj.view(-1)).squeeze(1)
+            doc_info['doc_labels'] = list(zip(conn.tolist(), adj.view(-1)[conn].tolist()))
+        if num_words <= max_words:
+            window = dict(example, word_offsets=list(range(num_words)), **doc_info)
+            windows.append(window)
+            continue
+
+        # sentence groups of consecutive words, sentences longer than max_words are cut into chunks
+        units = []
+        sent_ids = get_sent_ids(example)
+        for idx,sent_idx in enumerate(sent_ids):
+            if idx == 0 or sent_idx != sent_ids[idx-1] or len(units[-1]) == max_words:
+                units.append([])
+            units[-1].append(idx)
+
+        start = 0
+        while True:
+            end = start
+            size = 0
+            while end < len(units) and size + len(units[end]) <= max_words:
+                size += len(units[end])
+                end += 1
+            word_offsets = [idx for unit in units[start:end] for idx in unit]
+            window = {key: [example[key][idx] for idx in word_offsets] for key in ['words', 'sens', 'word_types']}
+            window['sent_ids'] = [sent_ids[idx] for idx in word_offsets]
+            if 'role_role_adj' in example:
+                index = torch.tensor(word_offsets)
+                window['role_role_adj'] = adj[index.unsqueeze(1), index.unsqueeze(0)].reshape(-1).tolist()
+            window['word_offsets'] = word_offsets
+            window.update(doc_info)
+            windows.append(window)
+            if end == len(units):
+                break
+            start = max(end - overlap_sents, start + 1)
+    return windows
+
+def merge_window_predictions(doc_len,windows):
+    '''
+    Merge the pair predictions of the windows of one document into document-level predictions.
+    windows is a list of (word_offsets, preds, confs) with flat window-level pair arrays. A pair scored
+    by several overlapping windows takes the prediction with the highest confidence, pairs that share
+    no window are non_conn.
+    '''
+    doc_preds = np.zeros(doc_len * doc_len, dtype=np.int64)
+    doc_confs = np.full(doc_len * doc_len, -1.0, dtype=np.float32)
+    for word_offsets,preds,confs in windows:
+        word_offsets = np.asarray(word_offsets)
+        pair_ids = (word_offsets[:, None] * doc_len + word_offsets[None, :]).reshape(-1)
+        better = confs > doc_confs[pair_ids]
+        doc_preds[pair_ids[better]] = preds[better]
+        doc_confs[pair_ids[better]] = confs[better]
+    return doc_preds
+
 def get_word_info(sent_idx,events,word,word_type,repeat_flag):
     word_info = {word: []}
     if repeat_flag:
@@ -224,9 +489,23 @@ def get_word_info(sent_idx,events,word,word_type,repeat_flag):
     return word_info
 
 
+def count_labels(examples):
+    '''
+    Count every pair label of the examples, indexed by label id.
+    '''
+    label_counts = [0]*len(role_role2idx)
+    for example in examples:
+        for label,num in Counter(example['role_role_adj']).items():
+            label_counts[label] += num
+    return label_counts
+
 def get_labels_weight(label_ids):
-    nums_labels = Counter(label_ids)
-    nums_labels = [(l,k) for k, l in sorted([(j, i) for i, j in nums_labels.items()], reverse=True)]
+    return get_labels_weight_from_counts(Counter(label_ids))
+
+def get_labels_weight_from_counts(label_counts):
+    if isinstance(label_counts, list):
+        label_counts = {label:num for label,num in enumerate(label_counts) if num > 0}
+    nums_labels = [(l,k) for k, l in sorted([(j, i) for i, j in label_counts.items()], reverse=True)]
     size = len(nums_labels)
     if size % 2 == 0:
         median = (nums_labels[size // 2][1] + nums_labels[size//2-1][1])/2
@@ -236,7 +515,7 @@ def get_labels_weight(label_ids):
     weight_list = []
     # roles_lookup = {'none': 0, 'sub': 1, 'pred': 2, 'obj': 3}
     for value_id in role_role2idx.values():
-        if value_id not in label_ids:
+        if value_id not in label_counts:
             weight_list.append(0)
         else:
             for label in nums_labels:
@@ -245,10 +524,11 @@ def get_labels_weight(label_ids):
                     break
     return weight_list
 
-def load_and_cache_vocabs(examples,args):
+def load_and_cache_vocabs(examples,args,appended_examples=None):
     '''
     Build vocabulary of words, part of speech tags, dependency tags and cache them.
     Load glove embedding if needed.
+    Cached vocabs are extended with the words of appended_examples, keeping the ids of known words stable.
     '''
     embedding_cache_path = os.path.join(args.cache_dir, 'embedding')
     if not os.path.exists(embedding_cache_path):
@@ -261,6 +541,12 @@ def load_and_cache_vocabs(examples,args):
         logger.info('Loading word vocab from %s', cached_word_vocab_file)
         with open(cached_word_vocab_file, 'rb') as f:
             word_vocab = pickle.load(f)
+        if appended_examples:
+            new_words = extend_vocab(word_vocab, [w for example in appended_examples for w in example['words']])
+            if new_words:
+                logger.info('Extending word vocab with %s new words to size %s', len(new_words), word_vocab['len'])
+                with open(cached_word_vocab_file, 'wb') as f:
+                    pickle.dump(word_vocab, f, -1)
     else:
         logger.info('Creating word vocab from dataset %s',args.dataset_name)
         word_vocab = build_text_vocab(examples)
@@ -274,6 +560,13 @@ def load_and_cache_vocabs(examples,args):
         logger.info('Loading word vecs from %s', cached_word_vecs_file)
         with open(cached_word_vecs_file, 'rb') as f:
             word_vecs = pickle.load(f)
+        if len(word_vecs) < word_vocab['len']:
+            # only the words appended since the vecs were cached need to be encoded
+            logger.info('Creating word vecs for %s new words', word_vocab['len'] - len(word_vecs))
+            word_vecs = list(word_vecs) + load_bert_embedding(word_vocab['itos'][len(word_vecs):])
+            logger.info('Saving word vecs to %s', cached_word_vecs_file)
+            with open(cached_word_vecs_file, 'wb') as f:
+                pickle.dump(word_vecs, f, -1)
     else:
         logger.info('Creating word vecs from %s', args.embedding_dir)
         word_vecs = load_bert_embedding(word_vocab['itos'])
@@ -288,6 +581,12 @@ def load_and_cache_vocabs(examples,args):
         logger.info('Loading vocab of word type tags from %s', cached_wType_tag_vocab_file)
         with open(cached_wType_tag_vocab_file, 'rb') as f:
             wType_tag_vocab = pickle.load(f)
+        if appended_examples:
+            new_tags = extend_vocab(wType_tag_vocab, [t for example in appended_examples for t in example['word_types']])
+            if new_tags:
+                logger.info('Extending vocab of word type tags with %s', new_tags)
+                with open(cached_wType_tag_vocab_file, 'wb') as f:
+                    pickle.dump(wType_tag_vocab, f, -1)
     else:
         logger.info('Creating vocab of word type tags.')
         wType_tag_vocab = build_wType_tag_vocab(examples, min_freq=0)
@@ -297,6 +596,25 @@ def load_and_cache_vocabs(examples,args):
 
     return word_vecs,word_vocab,wType_tag_vocab
 
+def load_cached_vocabs(args):
+    '''
+    Load the word vocab, word vecs and word type tag vocab cached by load_and_cache_vocabs, never writing them.
+    '''
+    embedding_cache_path = os.path.join(args.cache_dir, 'embedding')
+    cached_files = [os.path.join(embedding_cache_path, 'cached_{}_{}.pkl'.format(args.dataset_name, name))
+                    for name in ['word_vecs', 'word_vocab', 'wType_tag_vocab']]
+    missing = [cached_file for cached_file in cached_files if not os.path.exists(cached_file)]
+    if missing:
+        raise FileNotFoundError('Missing vocab caches {}, run run.py with --cache_dir {} first'.format(
+            ', '.join(missing), args.cache_dir))
+    cached = []
+    for cached_file in cached_files:
+        logger.info('Loading %s', cached_file)
+        with open(cached_file, 'rb') as f:
+            cached.append(pickle.load(f))
+    word_vecs,word_vocab,wType_tag_vocab = cached
+    return word_vecs,word_vocab,wType_tag_vocab
+
 def load_bert_embedding(word_list):
     word_vectors = []
     bc = BertClient()
@@ -333,6 +651,19 @@ def build_text_vocab(examples, vocab_size=1000000, min_freq=0):
 
     return {'itos': itos, 'stoi': stoi, 'len': len(itos)}
 
+def extend_vocab(vocab, tokens):
+    '''
+    Append unseen tokens to the end of vocab in first-seen order, so previously assigned ids never change.
+    '''
+    new_tokens = []
+    for tok in tokens:
+        if tok not in vocab['stoi']:
+            vocab['stoi'][tok] = len(vocab['itos'])
+            vocab['itos'].append(tok)
+            new_tokens.append(tok)
+    vocab['len'] = len(vocab['itos'])
+    return new_tokens
+
 def build_wType_tag_vocab(examples, vocab_size=1000, min_freq=0):
 
     counter = Counter()
@@ -372,6 +703,8 @@ class ED_Dataset(Dataset):
     def __getitem__(self, idx):
         e = self.examples[idx]
         items = e['word_ids'],e['wType_ids'],e['role_role_adj']
+        if 'pair_ids' in e:
+            items += (e['pair_ids'],)
 
         # items_tensor = tuple(torch.tensor(t) for t in items)
         return items
@@ -383,6 +716,20 @@ class ED_Dataset(Dataset):
         for i in range(len(self.examples)):
             self.examples[i]['word_ids'] = [self.word_vocab['stoi'][w] for w in self.examples[i]['words']]
             self.examples[i]['wType_ids'] = [self.wType_tag_vocab['stoi'][t] for t in self.examples[i]['word_types']]
+            if getattr(self.args, 'sent_window', -1) >= 0:
+                self.examples[i]['pair_ids'] = get_window_pair_ids(get_sent_ids(self.examples[i]),
+                                                                   self.examples[i]['word_types'],
+                                                                   self.args.sent_window,
+                                                                   self.args.max_global_tokens)
+
+
+def convert_inference_features(example,word_vocab,wType_tag_vocab):
+    '''
+    Like ED_Dataset.convert_features, but never inserts unseen words or word types into the vocabs.
+    '''
+    example['word_ids'] = [word_vocab['stoi'].get(w, _default_unk_index()) for w in example['words']]
+    example['wType_ids'] = [wType_tag_vocab['stoi'].get(t, wType_tag_vocab['stoi']['Other']) for t in example['word_types']]
+    return example
 
 
 def my_collate(batch):
@@ -392,13 +739,15 @@ def my_collate(batch):
     Turn all into tensors.
     '''
     # from Dataset.__getitem__()
-    word_ids,wType_ids,labels  = zip(
+    word_ids,wType_ids,labels,*pair_ids  = zip(
         *batch)  # from Dataset.__getitem__()
 
     word_ids = torch.tensor(word_ids[0])
     wType_ids = torch.tensor(wType_ids[0])
     labels = torch.tensor(labels[0])
 
+    if pair_ids:
+        return word_ids,wType_ids,labels,torch.tensor(pair_ids[0][0])
     return word_ids,wType_ids,labels
 
 """
@@ -0,0 +1,123 @@
+# coding=utf-8
+'''
+Export a trained EDEE to TorchScript and ONNX for serving without the Python model code.
+
+Both graphs take the word ids and word type ids of one document, with a dynamic number of
+words, and return the role_role logits of every word pair.
+'''
+import inspect
+import logging
+import os
+import numpy as np
+import torch
+
+from models import EDEE, load_state_dict_extended
+from run import build_parser, set_seed
+
+logger = logging.getLogger()
+
+INPUT_NAMES = ['word_ids', 'wType_ids']
+OUTPUT_NAMES = ['logits']
+
+
+def example_document(model,num_words=16):
+    word_ids = torch.randint(1, model.embed.num_embeddings, (num_words,))
+    wType_ids = torch.randint(0, model.word_type_embed.num_embeddings, (num_words,))
+    return word_ids,wType_ids
+
+
+def export_torchscript(model,path,document):
+    model.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, document)
+    traced.save(path)
+    return traced
+
+
+def export_onnx(model,path,document,opset_version=14):
+    model.eval()
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # the dynamo exporter of newer torch specializes the LSTM on the example length
+        kwargs['dynamo'] = False
+    torch.onnx.export(model, document, path,
+                      input_names=INPUT_NAMES, output_names=OUTPUT_NAMES,
+                      dynamic_axes={'word_ids': {0: 'num_words'}, 'wType_ids': {0: 'num_words'},
+                                    'logits': {0: 'num_pairs'}},
+                      opset_version=opset_version, **kwargs)
+
+
+def onnx_session(path,num_threads=1):
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = num_threads
+    return onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+
+def run_onnx(session,document):
+    word_ids, wType_ids = document
+    return session.run(OUTPUT_NAMES, {'word_ids': word_ids.numpy(), 'wType_ids': wType_ids.numpy()})[0]
+
+
+def check_parity(model,traced,session,documents,atol=1e-4):
+    '''
+    Compare the logits of the exported graphs with eager PyTorch on documents of different length.
+    '''
+    model.eval()
+    max_diff = 0.0
+    with torch.no_grad():
+        for document in documents:
+            eager_logits = model(*document).numpy()
+            outputs = [('torchscript', traced(*document).numpy())]
+            if session is not None:
+                outputs.append(('onnx', run_onnx(session, document)))
+            for name, logits in outputs:
+                diff = float(np.abs(logits - eager_logits).max())
+                logger.info('words=%d %s max abs diff = %.2e', len(document[0]), name, diff)
+                if diff > atol:
+                    raise AssertionError('{} logits differ from eager by {:.2e}'.format(name, diff))
+                max_diff = max(max_diff, diff)
+    return max_diff
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',level=logging.INFO)
+    parser = build_parser()
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='EDEE state_dict to export, defaults to output_dir/model.pt saved by run.py.')
+    parser.add_argument('--vocab_size', type=int, required=True, help='Rows of the word embedding of the checkpoint.')
+    parser.add_argument('--word_type_tag_num', type=int, required=True, help='Number of word type tags of the checkpoint.')
+    parser.add_argument('--parity_lengths', type=int, nargs='+', default=[3, 37, 150],
+                        help='Document lengths checked against eager PyTorch.')
+    parser.add_argument('--skip_onnx', action='store_true', help='Only export TorchScript.')
+    args = parser.parse_args()
+    args.device = torch.device('cpu')
+    set_seed(args)
+
+    # the frozen embedding is part of the checkpoint, so no dataset is needed to rebuild the model
+    args.token_embedding = torch.zeros(args.vocab_size, args.word_embedding_dim)
+    model = EDEE(args, args.word_type_tag_num)
+    checkpoint = args.checkpoint or os.path.join(args.output_dir, 'model.pt')
+    load_state_dict_extended(model, torch.load(checkpoint, map_location='cpu'))
+    model.eval()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    document = example_document(model)
+    torchscript_path = os.path.join(args.output_dir, 'edee.torchscript.pt')
+    traced = export_torchscript(model, torchscript_path, document)
+    logger.info('Saved TorchScript module to %s', torchscript_path)
+
+    session = None
+    if not args.skip_onnx:
+        onnx_path = os.path.join(args.output_dir, 'edee.onnx')
+        export_onnx(model, onnx_path, document)
+        logger.info('Saved ONNX graph to %s', onnx_path)
+        session = onnx_session(onnx_path)
+
+    check_parity(model, traced, session, [example_document(model, n) for n in args.parity_lengths])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# coding=utf-8
+'''
+Load generator for server.py, reports throughput and latency percentiles on localhost.
+
+Documents come from a ChFinAnn style json file (--input_file), or are synthesized when none is given.
+
+    python load_client.py --num_requests 500 --concurrency 16
+'''
+import argparse
+import asyncio
+import json
+import random
+import time
+import numpy as np
+
+SYNTHETIC_SENTENCES = ['本公司于近日接到股东通知，其所持有的本公司股份被司法冻结。',
+                       '冻结股份数量为1000万股，占公司总股本的2.5%。',
+                       '冻结起始日为2018年3月1日，冻结期限为三年。',
+                       '公司控股股东累计质押股份3000万股。',
+                       '本次减持后，该股东仍持有公司股份500万股。',
+                       '公司将持续关注上述事项的进展情况并及时履行信息披露义务。']
+
+
+def load_documents(args):
+    if args.input_file:
+        with open(args.input_file, 'r', encoding='utf-8-sig') as f:
+            datas = json.load(f)
+        return [{'sentences': doc[1]['sentences'], 'ann_mspan2guess_field': doc[1].get('ann_mspan2guess_field', {}),
+                 'ann_mspan2dranges': doc[1].get('ann_mspan2dranges')} for doc in datas]
+    rng = random.Random(args.seed)
+    return [{'sentences': [rng.choice(SYNTHETIC_SENTENCES) for _ in range(rng.randint(2, args.max_sentences))]}
+            for _ in range(args.num_documents)]
+
+
+async def worker(args,documents,counter,latencies,errors):
+    reader, writer = await asyncio.open_connection(args.host, args.port, limit=2**26)
+    while True:
+        request_id = counter[0]
+        if request_id >= args.num_requests:
+            break
+        counter[0] += 1
+        doc = dict(documents[request_id % len(documents)], id=request_id)
+        start = time.perf_counter()
+        writer.write((json.dumps(doc, ensure_ascii=False) + '\n').encode('utf-8'))
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        latencies.append((time.perf_counter() - start) * 1000)
+        if 'error' in response:
+            errors.append(response['error'])
+    writer.close()
+
+
+async def run(args):
+    documents = load_documents(args)
+    counter, latencies, errors = [0], [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(args, documents, counter, latencies, errors) for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies = np.asarray(latencies)
+    print('requests: {}, errors: {}, concurrency: {}'.format(len(latencies), len(errors), args.concurrency))
+    print('throughput: {:.1f} docs/s'.format(len(latencies) / elapsed))
+    print('latency ms: p50 {:.1f}, p90 {:.1f}, p99 {:.1f}, max {:.1f}'.format(
+        np.percentile(latencies, 50), np.percentile(latencies, 90), np.percentile(latencies, 99), latencies.max()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--input_file', type=str, default=None, help='ChFinAnn style json file to replay.')
+    parser.add_argument('--num_requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of connections sending requests.')
+    parser.add_argument('--num_documents', type=int, default=50, help='Synthetic documents to cycle through.')
+    parser.add_argument('--max_sentences', type=int, default=30, help='Longest synthetic document in sentences.')
+    parser.add_argument('--seed', type=int, default=2022)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,106 @@
 import torch
 import torch.nn as nn
-import itertools
+import torch.nn.functional as F
+from data_process import event_roles, event_type2idx, get_role_tag2idx, get_factorized_role_role_index
 
 torch.set_printoptions(profile="full")
 
+# args needed to rebuild an EDEE without the training data, stored inside exported model artifacts
+MODEL_ARG_NAMES = ['word_embedding_dim', 'word_type_embedding_dim', 'hidden_size', 'num_layers', 'num_mlps',
+                   'final_hidden_size', 'dropout', 'role_role_num', 'output_head', 'encoder', 'encoder_heads',
+                   'max_relative_distance']
+
+
+class BiLSTMEncoder(nn.Module):
+    def __init__(self,args,in_dim):
+        super(BiLSTMEncoder, self).__init__()
+        self.lstm = nn.LSTM(input_size=in_dim, hidden_size=args.hidden_size,
+                            bidirectional=True, batch_first=True, num_layers=args.num_layers)
+
+    def forward(self,token_feature):
+        out, _ = self.lstm(token_feature.unsqueeze(0))
+        return out.squeeze(0)
+
+
+class RelativeAttentionLayer(nn.Module):
+    def __init__(self,d_model,num_heads,dropout):
+        super(RelativeAttentionLayer, self).__init__()
+        self.num_heads = num_heads
+        self.qkv = nn.Linear(d_model, 3*d_model)
+        self.out = nn.Linear(d_model, d_model)
+        self.ff = nn.Sequential(nn.Linear(d_model, 2*d_model), nn.LeakyReLU(), nn.Dropout(dropout),
+                                nn.Linear(2*d_model, d_model))
+        self.norm1 = nn.LayerNorm(d_model)
+        self.norm2 = nn.LayerNorm(d_model)
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self,x,bias):
+        num_tokens, d_model = x.shape
+        # (num_heads, N, head_dim) queries, keys and values
+        q, k, v = self.qkv(x).reshape(num_tokens, 3, self.num_heads, -1).permute(1, 2, 0, 3).unbind(0)
+        attn = F.scaled_dot_product_attention(q, k, v, attn_mask=bias)
+        attn = attn.permute(1, 0, 2).reshape(num_tokens, d_model)
+        x = self.norm1(x + self.dropout(self.out(attn)))
+        return self.norm2(x + self.dropout(self.ff(x)))
+
+
+class RelativeTransformerEncoder(nn.Module):
+    '''
+    Transformer encoder whose attention gets a learned bias per head and clipped relative distance,
+    shared by all layers. All tokens are encoded in parallel.
+    '''
+    def __init__(self,args,in_dim):
+        super(RelativeTransformerEncoder, self).__init__()
+        d_model = 2*args.hidden_size
+        num_heads = getattr(args, 'encoder_heads', 4)
+        self.max_relative_distance = getattr(args, 'max_relative_distance', 64)
+        self.input_proj = nn.Linear(in_dim, d_model)
+        self.layers = nn.ModuleList([RelativeAttentionLayer(d_model, num_heads, args.dropout)
+                                     for _ in range(args.num_layers)])
+        self.relative_bias = nn.Embedding(2*self.max_relative_distance + 1, num_heads)
+
+    def forward(self,token_feature):
+        positions = torch.arange(token_feature.size(0), device=token_feature.device)
+        distance = (positions.unsqueeze(0) - positions.unsqueeze(1)).clamp(-self.max_relative_distance, self.max_relative_distance)
+        # (num_heads, N, N) additive attention bias
+        bias = self.relative_bias(distance + self.max_relative_distance).permute(2, 0, 1)
+        out = self.input_proj(token_feature)
+        for layer in self.layers:
+            out = layer(out, bias)
+        return out
+
+
+class DilatedConvEncoder(nn.Module):
+    '''
+    Residual stack of 1d convolutions with dilations 1,2,4,8,... repeated every 4 layers.
+    '''
+    def __init__(self,args,in_dim):
+        super(DilatedConvEncoder, self).__init__()
+        out_dim = 2*args.hidden_size
+        self.input_proj = nn.Linear(in_dim, out_dim)
+        self.convs = nn.ModuleList([nn.Conv1d(out_dim, out_dim, kernel_size=3, dilation=2**(i % 4), padding=2**(i % 4))
+                                    for i in range(args.num_layers)])
+        self.norms = nn.ModuleList([nn.LayerNorm(out_dim) for _ in range(args.num_layers)])
+        self.activation = nn.LeakyReLU()
+
+    def forward(self,token_feature):
+        out = self.input_proj(token_feature)
+        for conv,norm in zip(self.convs,self.norms):
+            out = norm(out + self.activation(conv(out.t().unsqueeze(0)).squeeze(0).t()))
+        return out
+
+
+ENCODERS = {'bilstm': BiLSTMEncoder,
+            'transformer': RelativeTransformerEncoder,
+            'dilated_cnn': DilatedConvEncoder}
+
+
+def build_encoder(args,in_dim):
+    '''
+    Token encoder selected by args.encoder, mapping (N, in_dim) features to (N, 2*hidden_size).
+    '''
+    return ENCODERS[getattr(args, 'encoder', 'bilstm')](args, in_dim)
+
 
 class EDEE(nn.Module):
     def __init__(self,args,word_type_tag_num):
@@ -20,8 +117,7 @@ class EDEE(nn.Module):
 
 
         in_dim = args.word_embedding_dim+args.word_type_embedding_dim
-        self.token_bilstm = nn.LSTM(input_size=in_dim, hidden_size=args.hidden_size,
-                              bidirectional=True, batch_first=True, num_layers=args.num_layers)
+        self.token_encoder = build_encoder(args,in_dim)
 
         last_hidden_size = 4*args.hidden_size
         layers = [nn.Linear(last_hidden_size, args.final_hidden_size), nn.LeakyReLU()]
@@ -29,9 +125,16 @@ class EDEE(nn.Module):
             layers += [nn.Linear(args.final_hidden_size,
                                  args.final_hidden_size), nn.LeakyReLU()]
         self.fcs = nn.Sequential(*layers)
-        self.fc_final = nn.Linear(args.final_hidden_size, args.role_role_num)
+        if getattr(args, 'output_head', 'flat') == 'factorized':
+            self.fc_final = FactorizedRoleRoleHead(args.final_hidden_size)
+        else:
+            self.fc_final = nn.Linear(args.final_hidden_size, args.role_role_num)
+
+    def forward(self,word_ids,wType_ids,pair_ids=None):
+        token_out = self.encode(word_ids,wType_ids)
+        return self.score_pairs(token_out,pair_ids)
 
-    def forward(self,word_ids,wType_ids):
+    def encode(self,word_ids,wType_ids):
         token_feature = self.embed(word_ids)
         token_feature = self.dropout(token_feature)
         token_type_feature = self.word_type_embed(wType_ids)
@@ -39,20 +142,218 @@ class EDEE(nn.Module):
 
         all_token_feature = torch.cat([token_feature,token_type_feature],dim=1)
 
-        token_out_bilstm, _ = self.token_bilstm(all_token_feature.unsqueeze(0))
-        token_out_bilstm = self.dropout(token_out_bilstm).squeeze(0)
+        token_out = self.token_encoder(all_token_feature)
+        token_out = self.dropout(token_out)
+        return token_out
+
+    def pair_features(self,token_out,pair_ids=None):
+        '''
+        Hidden features of the word pairs given by their flat ids i*N+j, or of all N*N pairs when pair_ids is None.
+        '''
+        return self.fcs(self.pair_inputs(token_out,pair_ids))
+
+    def pair_inputs(self,token_out,pair_ids=None):
+        '''
+        Concatenated token features [token_i, token_j] of the pairs, the input of fcs.
+        '''
+        num_tokens = token_out.size(0)
+        if pair_ids is None:
+            # row i*N+j holds [token_i, token_j], the order of itertools.product over the tokens
+            ent_ent_feature = torch.cat([token_out.unsqueeze(1).expand(num_tokens, num_tokens, -1),
+                                         token_out.unsqueeze(0).expand(num_tokens, num_tokens, -1)], dim=-1)
+            ent_ent_feature = ent_ent_feature.reshape(num_tokens * num_tokens, -1)
+        else:
+            rows = torch.div(pair_ids, num_tokens, rounding_mode='floor')
+            cols = pair_ids % num_tokens
+            ent_ent_feature = torch.cat([token_out[rows],token_out[cols]],dim=-1)
+
+        return ent_ent_feature
+
+    def score_pairs(self,token_out,pair_ids=None):
+        '''
+        Logits of the word pairs given by their flat ids i*N+j, or of all N*N pairs when pair_ids is None.
+        '''
+        return self.fc_final(self.pair_features(token_out,pair_ids))
+
+    def pair_loss(self,pair_feature,labels,labels_weight,sample_weight=None):
+        '''
+        Class weighted cross entropy of the pairs, sample_weight scales the loss of every pair.
+        The factorized head is trained on its factors, without the logits of all labels.
+        '''
+        if sample_weight is None:
+            sample_weight = torch.ones(labels.shape, dtype=pair_feature.dtype, device=pair_feature.device)
+        if isinstance(self.fc_final, FactorizedRoleRoleHead):
+            return self.fc_final.loss(pair_feature,labels,labels_weight,sample_weight)
+        log_probs = F.log_softmax(self.fc_final(pair_feature), dim=-1)
+        return weighted_nll_loss(log_probs,labels,labels_weight,sample_weight)
+
+    def non_conn_log_probs(self,pair_feature):
+        '''
+        Log-probability that each pair is non_conn.
+        '''
+        if isinstance(self.fc_final, FactorizedRoleRoleHead):
+            conn = self.fc_final.factor_logits(pair_feature)[0]
+        else:
+            conn = self.fc_final(pair_feature)
+        return F.log_softmax(conn, dim=-1)[:, 0]
+
+    def predict_pairs(self,pair_feature):
+        '''
+        Predicted label of every pair and its probability.
+        '''
+        if isinstance(self.fc_final, FactorizedRoleRoleHead):
+            return self.fc_final.predict(pair_feature)
+        probs = torch.softmax(self.fc_final(pair_feature), dim=-1)
+        confs, preds = probs.max(dim=-1)
+        return preds, confs
+
+
+def weighted_nll_loss(log_probs,target,class_weight,sample_weight):
+    '''
+    Mean negative log-likelihood of target, weighted per pair by its class weight times its sample weight.
+    '''
+    weight = class_weight[target] * sample_weight
+    loss = -log_probs.gather(1, target.unsqueeze(1)).squeeze(1)
+    return (loss * weight).sum() / weight.sum().clamp(min=1e-12)
+
+
+def median_frequency_weights(freq):
+    '''
+    median/freq for every class that occurs, 0 for the others, like datasets.get_labels_weight_from_counts.
+    '''
+    present = freq > 0
+    weight = torch.zeros_like(freq)
+    if present.any():
+        weight[present] = torch.quantile(freq[present], 0.5) / freq[present]
+    return weight
+
+
+class FactorizedRoleRoleHead(nn.Module):
+    '''
+    Predict connectivity, event type and the two B_/I_ role tags of a pair with separate softmaxes,
+    then recombine them into log-probabilities over the labels of get_role_role2idx.
+    Role tags are softmaxed only over the tags of the event type they are conditioned on.
+    '''
+    def __init__(self,in_dim):
+        super(FactorizedRoleRoleHead, self).__init__()
+        role_tag2idx = get_role_tag2idx()
+        self.num_event_types = len(event_type2idx)
+        self.num_role_tags = len(role_tag2idx)
+        self.fc = nn.Linear(in_dim, 2 + self.num_event_types + 2*self.num_role_tags)
+
+        tag_mask = torch.full((self.num_event_types, self.num_role_tags), float('-inf'))
+        label_table = torch.zeros(self.num_event_types, self.num_role_tags, self.num_role_tags, dtype=torch.long)
+        for event_type,roles in event_roles.items():
+            for role in roles:
+                tag_mask[event_type2idx[event_type], role_tag2idx[role]] = 0
+        event_types, role1_tags, role2_tags = get_factorized_role_role_index()
+        event_types = torch.tensor(event_types)
+        role1_tags = torch.tensor(role1_tags)
+        role2_tags = torch.tensor(role2_tags)
+        label_table[event_types, role1_tags, role2_tags] = torch.arange(1, len(event_types) + 1)
+        self.register_buffer('tag_mask', tag_mask)
+        self.register_buffer('label_table', label_table)
+        # factors of label i+1, not saved so older checkpoints still load
+        self.register_buffer('label_event_types', event_types, persistent=False)
+        self.register_buffer('label_role1_tags', role1_tags, persistent=False)
+        self.register_buffer('label_role2_tags', role2_tags, persistent=False)
+        # role tags of every event type, labels are laid out per event type with role1 major
+        self.role_nums = [len(roles) for roles in event_roles.values()]
+        self.register_buffer('event_role_tags', torch.tensor([role_tag2idx[role] for roles in event_roles.values() for role in roles]))
+
+    def factor_logits(self,x):
+        return self.fc(x).split([2, self.num_event_types, self.num_role_tags, self.num_role_tags], dim=-1)
+
+    def factor_log_probs(self,x):
+        conn, event_type, role1, role2 = self.factor_logits(x)
+        conn = F.log_softmax(conn, dim=-1)
+        event_type = F.log_softmax(event_type, dim=-1)
+        role1 = F.log_softmax(role1.unsqueeze(1) + self.tag_mask, dim=-1)
+        role2 = F.log_softmax(role2.unsqueeze(1) + self.tag_mask, dim=-1)
+        return conn, event_type, role1, role2
+
+    def forward(self,x):
+        conn, event_type, role1, role2 = self.factor_log_probs(x)
+        log_probs = [conn[:, :1]]
+        start = 0
+        for event_type_idx,role_num in enumerate(self.role_nums):
+            tags = self.event_role_tags[start:start + role_num]
+            role_role = role1[:, event_type_idx, tags].unsqueeze(2) + role2[:, event_type_idx, tags].unsqueeze(1)
+            log_probs.append(role_role.reshape(x.size(0), -1) + conn[:, 1:] + event_type[:, event_type_idx:event_type_idx + 1])
+            start += role_num
+        return torch.cat(log_probs, dim=1)
+
+    def factor_weights(self,labels_weight):
+        '''
+        Class weights of the connectivity, event type and role tag factors. labels_weight is median/count per
+        label, so 1/labels_weight gives relative label counts, which are summed per factor class and weighted
+        the same way.
+        '''
+        freq = torch.where(labels_weight > 0, 1 / labels_weight.clamp(min=1e-12), torch.zeros_like(labels_weight))
+        conn_freq = torch.stack([freq[0], freq[1:].sum()])
+        event_type_freq = freq.new_zeros(self.num_event_types).index_add_(0, self.label_event_types, freq[1:])
+        role1_freq = freq.new_zeros(self.num_role_tags).index_add_(0, self.label_role1_tags, freq[1:])
+        role2_freq = freq.new_zeros(self.num_role_tags).index_add_(0, self.label_role2_tags, freq[1:])
+        return [median_frequency_weights(f) for f in [conn_freq, event_type_freq, role1_freq, role2_freq]]
 
-        ent_ent_list = list(itertools.product(token_out_bilstm,repeat=2))
-        ent_ent_emb = []
-        for ent_ent in ent_ent_list:
-            ent_ent_emb.append(torch.cat([ent_ent[0],ent_ent[1]],dim=0))
+    def loss(self,x,labels,labels_weight,sample_weight):
+        '''
+        Sum of the class weighted cross entropies of the factors: connectivity over all pairs, event type and
+        the two role tags over the connected pairs, role tags softmaxed over the tags of the gold event type.
+        '''
+        conn_weight, event_type_weight, role1_weight, role2_weight = self.factor_weights(labels_weight)
+        conn, event_type, role1, role2 = self.factor_logits(x)
+        connected = labels > 0
+        loss = weighted_nll_loss(F.log_softmax(conn, dim=-1), connected.long(), conn_weight, sample_weight)
 
-        ent_ent_feature = torch.stack(ent_ent_emb,dim=0)
+        label_idx = labels[connected] - 1
+        if label_idx.numel() == 0:
+            return loss
+        event_types = self.label_event_types[label_idx]
+        tag_mask = self.tag_mask[event_types]
+        sample_weight = sample_weight[connected]
+        loss = loss + weighted_nll_loss(F.log_softmax(event_type[connected], dim=-1), event_types,
+                                        event_type_weight, sample_weight)
+        loss = loss + weighted_nll_loss(F.log_softmax(role1[connected] + tag_mask, dim=-1),
+                                        self.label_role1_tags[label_idx], role1_weight, sample_weight)
+        loss = loss + weighted_nll_loss(F.log_softmax(role2[connected] + tag_mask, dim=-1),
+                                        self.label_role2_tags[label_idx], role2_weight, sample_weight)
+        return loss
 
-        out = self.fcs(ent_ent_feature)
-        logits = self.fc_final(out)
+    def predict(self,x):
+        '''
+        Argmax label of every pair and its probability, without materializing the log-probabilities of all labels.
+        '''
+        conn, event_type, role1, role2 = self.factor_log_probs(x)
+        best_role1, role1_tags = role1.max(dim=-1)
+        best_role2, role2_tags = role2.max(dim=-1)
+        best_connected, event_types = (event_type + best_role1 + best_role2).max(dim=-1)
+        role1_tags = role1_tags.gather(1, event_types.unsqueeze(1)).squeeze(1)
+        role2_tags = role2_tags.gather(1, event_types.unsqueeze(1)).squeeze(1)
+        labels = self.label_table[event_types, role1_tags, role2_tags]
+        best_connected = conn[:, 1] + best_connected
+        is_connected = best_connected > conn[:, 0]
+        labels = torch.where(is_connected, labels, torch.zeros_like(labels))
+        return labels, torch.exp(torch.where(is_connected, best_connected, conn[:, 0]))
 
-        return logits
 
+def load_state_dict_extended(model,state_dict):
+    '''
+    Load a checkpoint saved before the word/word type vocabs were extended by appended documents.
+    Embedding rows of the checkpoint are copied into the leading rows of the larger matrices,
+    rows of new words keep the values the model was built with.
+    '''
+    own_state = model.state_dict()
+    for name,param in state_dict.items():
+        if name.startswith('token_bilstm.'):
+            # checkpoints from before the pluggable encoders
+            name = 'token_encoder.lstm.' + name[len('token_bilstm.'):]
+        own_param = own_state[name]
+        if param.dim() > 0 and param.shape[1:] == own_param.shape[1:] and param.shape[0] < own_param.shape[0]:
+            own_param[:param.shape[0]].copy_(param)
+        else:
+            own_param.copy_(param)
 
 
+def get_model_config(args):
+    return {name:getattr(args,name) for name in MODEL_ARG_NAMES}
@@ -0,0 +1,143 @@
+# coding=utf-8
+'''
+Dynamic int8 quantization of EDEE for CPU-only inference.
+
+The LSTM and Linear layers are quantized with torch dynamic quantization, the frozen word
+embedding can additionally be stored in int8 (per-row scale) or fp16.
+'''
+import argparse
+import logging
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, SequentialSampler
+
+from datasets import load_datasets_and_vocabs, my_collate, idx2role_role, idx2event_type
+from models import EDEE, get_model_config, load_state_dict_extended
+from run import build_parser, set_seed
+from trainer import compute_metrics, get_input_from_batch
+
+logger = logging.getLogger()
+
+
+class QuantizedEmbedding(nn.Module):
+    '''
+    Frozen embedding stored in int8 with one scale per row, or in fp16. Lookups return fp32.
+    '''
+    def __init__(self,weight,embedding_dtype):
+        super(QuantizedEmbedding, self).__init__()
+        self.embedding_dtype = embedding_dtype
+        if embedding_dtype == 'int8':
+            scale = weight.abs().max(dim=1)[0].clamp(min=1e-8) / 127
+            self.register_buffer('weight', torch.round(weight / scale.unsqueeze(1)).to(torch.int8))
+            self.register_buffer('scale', scale)
+        elif embedding_dtype == 'fp16':
+            self.register_buffer('weight', weight.half())
+            self.register_buffer('scale', None)
+        else:
+            raise ValueError('Unsupported embedding dtype: {}'.format(embedding_dtype))
+
+    def forward(self,ids):
+        feature = self.weight[ids].float()
+        if self.scale is not None:
+            feature = feature * self.scale[ids].unsqueeze(-1)
+        return feature
+
+
+def quantize_model(model,embedding_dtype='fp32'):
+    '''
+    Return an int8 dynamically quantized copy of model for CPU inference.
+    '''
+    model = model.to('cpu').eval()
+    qmodel = torch.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    if embedding_dtype != 'fp32':
+        qmodel.embed = QuantizedEmbedding(qmodel.embed.weight.data, embedding_dtype)
+    return qmodel
+
+
+def save_quantized(qmodel,args,word_type_tag_num,embedding_dtype,path):
+    num_embeddings, _ = args.token_embedding.shape
+    torch.save({'config': get_model_config(args),
+                'num_embeddings': num_embeddings,
+                'word_type_tag_num': word_type_tag_num,
+                'embedding_dtype': embedding_dtype,
+                'state_dict': qmodel.state_dict()}, path)
+
+
+def load_quantized(path):
+    '''
+    Rebuild a quantized EDEE saved by save_quantized, the training data is not needed.
+    '''
+    artifact = torch.load(path, map_location='cpu', weights_only=False)
+    args = argparse.Namespace(**artifact['config'])
+    args.token_embedding = torch.zeros(artifact['num_embeddings'], args.word_embedding_dim)
+    model = EDEE(args, artifact['word_type_tag_num'])
+    qmodel = quantize_model(model, artifact['embedding_dtype'])
+    qmodel.load_state_dict(artifact['state_dict'])
+    return qmodel
+
+
+def predict(model,dataset):
+    dataloader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=1, collate_fn=my_collate)
+    final_preds = []
+    out_label_ids = []
+    model.eval()
+    with torch.no_grad():
+        for batch in dataloader:
+            inputs, labels = get_input_from_batch(batch)
+            token_feature = model.encode(inputs['word_ids'], inputs['wType_ids'])
+            preds, _ = model.predict_pairs(model.pair_features(token_feature, inputs.get('pair_ids')))
+            final_preds += preds.tolist()
+            out_label_ids += labels.tolist()
+    return final_preds,out_label_ids
+
+
+def compare_to_fp32(model,qmodel,dataset):
+    '''
+    Per event type metrics of the fp32 and the quantized model on the same dataset.
+    '''
+    fp32_preds, labels = predict(model, dataset)
+    int8_preds, _ = predict(qmodel, dataset)
+    fp32_result = compute_metrics(fp32_preds, labels, idx2role_role)
+    int8_result = compute_metrics(int8_preds, labels, idx2role_role)
+
+    agreement = np.mean(np.asarray(fp32_preds) == np.asarray(int8_preds))
+    logger.info('***** Quantized vs fp32 *****')
+    logger.info('  pair prediction agreement = %.6f', agreement)
+    for event_type in idx2event_type.values():
+        logger.info('  %s: fp32 f1 = %.4f, int8 f1 = %.4f, delta = %+.4f', event_type,
+                    fp32_result[event_type]['f1'], int8_result[event_type]['f1'],
+                    int8_result[event_type]['f1'] - fp32_result[event_type]['f1'])
+    return fp32_result,int8_result
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',level=logging.INFO)
+    parser = build_parser()
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='fp32 EDEE state_dict to quantize, defaults to output_dir/model.pt saved by run.py.')
+    parser.add_argument('--quantized_path', type=str, default=None,
+                        help='Where to save the quantized model, defaults to output_dir/edee_int8.pt.')
+    parser.add_argument('--embedding_dtype', type=str, default='fp32', choices=['fp32', 'fp16', 'int8'],
+                        help='Storage type of the frozen word embedding.')
+    args = parser.parse_args()
+    args.device = torch.device('cpu')
+    set_seed(args)
+
+    _,_,_,_,test_dataset,_,_,wType_tag_vocab = load_datasets_and_vocabs(args)
+
+    model = EDEE(args,wType_tag_vocab['len'])
+    checkpoint = args.checkpoint or os.path.join(args.output_dir, 'model.pt')
+    load_state_dict_extended(model, torch.load(checkpoint, map_location='cpu'))
+    qmodel = quantize_model(model, args.embedding_dtype)
+
+    quantized_path = args.quantized_path or os.path.join(args.output_dir, 'edee_int8.pt')
+    save_quantized(qmodel, args, wType_tag_vocab['len'], args.embedding_dtype, quantized_path)
+    logger.info('Saved quantized model to %s', quantized_path)
+
+    compare_to_fp32(model, load_quantized(quantized_path), test_dataset)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,7 +18,7 @@ def set_seed(args):
     torch.cuda.manual_seed_all(args.seed)
 
 
-def parse_args():
+def build_parser():
     parser = argparse.ArgumentParser()
 
     # Required parameters
@@ -29,6 +29,10 @@ def parse_args():
     parser.add_argument('--role_role_num', type=int, default=1013, help='Number of classes.')
     parser.add_argument('--seed', type=int, default=2022, help='random seed for initialization')
     parser.add_argument('--cuda_id', type=str, default='0', help='Choose which GPUs to run')
+    parser.add_argument('--append_file', type=str, default=None,
+                        help='New documents to append to the cached examples without rebuilding the caches.')
+    parser.add_argument('--append_split', type=str, default='train', choices=['train', 'dev', 'test'],
+                        help='Which split the documents of append_file are appended to.')
 
     # Model parameters
     parser.add_argument('--embedding_dir', type=str, default='./model', help='Directory storing embeddings')
@@ -37,15 +41,35 @@ def parse_args():
 
 
     # MLP
+    parser.add_argument('--encoder', type=str, default='bilstm', choices=['bilstm', 'transformer', 'dilated_cnn'],
+                        help='Token encoder, all of them output 2*hidden_size features per word.')
     parser.add_argument('--hidden_size', type=int, default=200,
                         help='Hidden size of bilstm, in early stage.')
     parser.add_argument('--num_layers', type=int, default=4,
-                        help='Number of layers of bilstm.')
+                        help='Number of layers of the token encoder.')
+    parser.add_argument('--encoder_heads', type=int, default=4, help='Attention heads of the transformer encoder.')
+    parser.add_argument('--max_relative_distance', type=int, default=64,
+                        help='Relative distances of the transformer encoder are clipped to this value.')
     parser.add_argument('--num_mlps', type=int, default=4, help='Number of mlps in the last of model.')
     parser.add_argument('--final_hidden_size', type=int, default=200, help='Hidden size of mlps.')
+    parser.add_argument('--output_head', type=str, default='flat', choices=['flat', 'factorized'],
+                        help='flat: one linear over all role_role labels. factorized: separate softmaxes for '
+                             'connectivity, event type and the two role tags, recombined into the same labels.')
 
     parser.add_argument('--dropout', type=float, default=0.2, help='Dropout rate for embedding.')
 
+    # Block-sparse pair graph
+    parser.add_argument('--sent_window', type=int, default=-1,
+                        help='Only score word pairs at most this many sentences apart, -1 scores all pairs.')
+    parser.add_argument('--max_global_tokens', type=int, default=16,
+                        help='Typed words paired with every word regardless of sent_window.')
+
+    # Overlong documents
+    parser.add_argument('--max_doc_words', type=int, default=0,
+                        help='Split documents longer than this into sentence-aligned windows, 0 keeps whole documents.')
+    parser.add_argument('--window_overlap_sents', type=int, default=2,
+                        help='Sentences shared by consecutive windows.')
+
     # Training parameters
     parser.add_argument("--per_gpu_train_batch_size", default=1, type=int,
                         help="Batch size per GPU/CPU for training.")
@@ -61,9 +85,18 @@ def parse_args():
                         help="If > 0: set total number of training steps(that update the weights) to perform. Override num_train_epochs.")
     parser.add_argument('--logging_steps', type=int, default=20,
                         help="Log every X updates steps.")
+    parser.add_argument('--neg_sampling', type=str, default='none', choices=['none', 'random', 'hard'],
+                        help='Train on all connected pairs plus a sample of non_conn pairs per document.')
+    parser.add_argument('--num_neg_samples', type=int, default=2000,
+                        help='Number of non_conn pairs sampled per document.')
+    parser.add_argument('--hard_candidate_factor', type=int, default=4,
+                        help='hard sampling mines hard negatives among this many times num_neg_samples random non_conn pairs.')
 
+    return parser
 
-    return parser.parse_args()
+
+def parse_args():
+    return build_parser().parse_args()
 
 
 def check_args(args):
@@ -0,0 +1,261 @@
+# coding=utf-8
+'''
+Asyncio extraction server around EDEE.
+
+Clients send one JSON document per line, {"id": ..., "sentences": [...], "ann_mspan2guess_field": {...},
+"ann_mspan2dranges": {...}} (mention ranges are optional), and get back one JSON line per document with the
+connected word pairs. Documents are segmented into word nodes by create_inference_example in a thread pool,
+grouped into micro-batches bounded by max_wait_ms and max_batch_pairs, and scored in a dedicated
+single-thread executor so the event loop never blocks on the model. The word pairs of a micro-batch go
+through the pair MLP together.
+
+    python server.py --output_dir ./output --port 8765
+'''
+import asyncio
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from ltp import LTP
+
+from datasets import load_cached_vocabs, create_inference_example, convert_inference_features, idx2role_role, \
+    split_overlong_examples, merge_window_predictions, get_window_pair_ids
+from models import EDEE, load_state_dict_extended
+from run import build_parser, set_seed
+
+logger = logging.getLogger()
+
+
+class ExtractionServer(object):
+    def __init__(self,model,word_vocab,wType_tag_vocab,user_dict_file=None,max_batch_pairs=250000,
+                 max_wait_ms=10,max_queue=64,tokenize_workers=2,max_doc_words=0,window_overlap_sents=2,
+                 sent_window=-1,max_global_tokens=16):
+        self.model = model.eval()
+        self.word_vocab = word_vocab
+        self.wType_tag_vocab = wType_tag_vocab
+        self.user_dict_file = user_dict_file
+        self.max_batch_pairs = max_batch_pairs
+        self.max_wait = max_wait_ms / 1000
+        self.max_doc_words = max_doc_words
+        self.window_overlap_sents = window_overlap_sents
+        self.sent_window = sent_window
+        self.max_global_tokens = max_global_tokens
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        # one slot per admitted document, connections stop being read while all slots are taken
+        self.slots = asyncio.Semaphore(max_queue)
+        self.tokenize_executor = ThreadPoolExecutor(tokenize_workers, thread_name_prefix='tokenize')
+        self.model_executor = ThreadPoolExecutor(1, thread_name_prefix='model')
+        self.local = threading.local()
+        self.carry = None
+
+    def get_ltp(self):
+        # ltp is not thread safe, every tokenize worker keeps its own instance
+        if not hasattr(self.local, 'ltp'):
+            self.local.ltp = LTP()
+            if self.user_dict_file and os.path.exists(self.user_dict_file):
+                self.local.ltp.init_dict(path=self.user_dict_file)
+        return self.local.ltp
+
+    def preprocess(self,doc):
+        example = create_inference_example(doc['sentences'], self.get_ltp(), doc.get('ann_mspan2guess_field'),
+                                           doc.get('ann_mspan2dranges'))
+        if 0 < self.max_doc_words < len(example['words']):
+            example['windows'] = [self.convert_features(window)
+                                  for window in split_overlong_examples([example], self.max_doc_words, self.window_overlap_sents)]
+            return example
+        return self.convert_features(example)
+
+    def convert_features(self,example):
+        example = convert_inference_features(example, self.word_vocab, self.wType_tag_vocab)
+        if self.sent_window >= 0:
+            # score only the pairs the model was trained on, like ED_Dataset.convert_features
+            example['pair_ids'] = get_window_pair_ids(example['sent_ids'], example['word_types'],
+                                                      self.sent_window, self.max_global_tokens)
+        return example
+
+    @staticmethod
+    def num_pairs(example):
+        units = example.get('windows', [example])
+        return sum(len(unit['pair_ids']) if 'pair_ids' in unit else len(unit['words']) ** 2 for unit in units)
+
+    def infer(self,examples):
+        '''
+        Score a micro-batch. Every document or window is encoded on its own, then the pairs of the whole
+        batch go through fcs and fc_final in one call and the predictions are split back per document.
+        '''
+        units = [(idx, unit) for idx, example in enumerate(examples) if len(example['words']) > 0
+                 for unit in example.get('windows', [example])]
+        if not units:
+            return [[] for _ in examples]
+        with torch.no_grad():
+            pair_inputs = []
+            for _, unit in units:
+                token_feature = self.model.encode(torch.tensor(unit['word_ids']), torch.tensor(unit['wType_ids']))
+                pair_ids = torch.tensor(unit['pair_ids']) if 'pair_ids' in unit else None
+                pair_inputs.append(self.model.pair_inputs(token_feature, pair_ids))
+            preds, confs = self.model.predict_pairs(self.model.fcs(torch.cat(pair_inputs)))
+        split_points = np.cumsum([len(unit_inputs) for unit_inputs in pair_inputs])[:-1]
+        unit_preds = np.split(preds.numpy(), split_points)
+        unit_confs = np.split(confs.numpy(), split_points)
+
+        scored = [[] for _ in examples]
+        for (idx, unit), preds, confs in zip(units, unit_preds, unit_confs):
+            if 'pair_ids' in unit:
+                # pairs outside the sentence window are never scored and count as non_conn, as in evaluate
+                num_unit_pairs = len(unit['words']) ** 2
+                full_preds = np.zeros(num_unit_pairs, dtype=preds.dtype)
+                full_preds[unit['pair_ids']] = preds
+                full_confs = np.zeros(num_unit_pairs, dtype=confs.dtype)
+                full_confs[unit['pair_ids']] = confs
+                preds, confs = full_preds, full_confs
+            scored[idx].append((unit, preds, confs))
+
+        results = []
+        for example, example_scored in zip(examples, scored):
+            if not example_scored:
+                results.append([])
+                continue
+            num_words = len(example['words'])
+            if 'windows' in example:
+                preds = merge_window_predictions(num_words, [(unit['word_offsets'], preds, confs)
+                                                             for unit, preds, confs in example_scored])
+            else:
+                preds = example_scored[0][1]
+            pairs = []
+            for pair_idx in np.nonzero(preds)[0].tolist():
+                event_type, role1, role2 = idx2role_role[preds[pair_idx]]
+                w1, w2 = divmod(pair_idx, num_words)
+                pairs.append([example['words'][w1], example['words'][w2], event_type, role1, role2])
+            results.append(pairs)
+        return results
+
+    async def extract(self,doc):
+        loop = asyncio.get_running_loop()
+        example = await loop.run_in_executor(self.tokenize_executor, self.preprocess, doc)
+        future = loop.create_future()
+        await self.queue.put((example, future))
+        return await future
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        item = self.carry if self.carry is not None else await self.queue.get()
+        self.carry = None
+        batch = [item]
+        num_pairs = self.num_pairs(item[0])
+        deadline = loop.time() + self.max_wait
+        while num_pairs < self.max_batch_pairs:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            item_pairs = self.num_pairs(item[0])
+            if num_pairs + item_pairs > self.max_batch_pairs:
+                # keep the document for the next batch instead of overrunning the pair budget
+                self.carry = item
+                break
+            batch.append(item)
+            num_pairs += item_pairs
+        return batch
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            try:
+                results = await loop.run_in_executor(self.model_executor, self.infer, [example for example, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def handle_request(self,line,writer):
+        try:
+            doc = json.loads(line)
+            response = {'id': doc.get('id'), 'pairs': await self.extract(doc)}
+        except Exception as e:
+            logger.exception('Failed to extract document')
+            response = {'error': str(e)}
+        finally:
+            self.slots.release()
+        writer.write((json.dumps(response, ensure_ascii=False) + '\n').encode('utf-8'))
+        await writer.drain()
+
+    async def handle_connection(self,reader,writer):
+        tasks = set()
+        while True:
+            await self.slots.acquire()
+            line = await reader.readline()
+            if not line:
+                self.slots.release()
+                break
+            task = asyncio.ensure_future(self.handle_request(line, writer))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        writer.close()
+
+    async def serve(self,host,port):
+        batcher = asyncio.ensure_future(self.batch_loop())
+        # long documents do not fit in the default 64KiB line limit of asyncio streams
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=2**26)
+        logger.info('Serving EDEE on %s:%s', host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.tokenize_executor.shutdown(wait=False)
+            self.model_executor.shutdown(wait=False)
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',level=logging.INFO)
+    parser = build_parser()
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='fp32 EDEE state_dict to serve, defaults to output_dir/model.pt saved by run.py.')
+    parser.add_argument('--quantized_model', type=str, default=None, help='Quantized artifact saved by quantization.py.')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max_batch_pairs', type=int, default=250000, help='Word pairs scored per micro-batch.')
+    parser.add_argument('--max_wait_ms', type=float, default=10, help='Longest wait for a micro-batch to fill.')
+    parser.add_argument('--max_queue', type=int, default=64, help='Documents admitted before backpressure.')
+    parser.add_argument('--tokenize_workers', type=int, default=2, help='Threads segmenting documents.')
+    parser.add_argument('--num_threads', type=int, default=4, help='torch intra-op threads of the model executor.')
+    args = parser.parse_args()
+    args.device = torch.device('cpu')
+    torch.set_num_threads(args.num_threads)
+    set_seed(args)
+
+    # vocabs and word vecs come from the caches written at training time
+    word_vecs,word_vocab,wType_tag_vocab = load_cached_vocabs(args)
+    if args.quantized_model:
+        from quantization import load_quantized
+        model = load_quantized(args.quantized_model)
+    else:
+        args.token_embedding = torch.from_numpy(np.asarray(word_vecs, dtype=np.float32))
+        model = EDEE(args, wType_tag_vocab['len'])
+        checkpoint = args.checkpoint or os.path.join(args.output_dir, 'model.pt')
+        load_state_dict_extended(model, torch.load(checkpoint, map_location='cpu'))
+
+    server = ExtractionServer(model, word_vocab, wType_tag_vocab,
+                              user_dict_file=os.path.join(args.dataset_path, 'company.txt'),
+                              max_batch_pairs=args.max_batch_pairs, max_wait_ms=args.max_wait_ms,
+                              max_queue=args.max_queue, tokenize_workers=args.tokenize_workers,
+                              max_doc_words=args.max_doc_words, window_overlap_sents=args.window_overlap_sents,
+                              sent_window=args.sent_window, max_global_tokens=args.max_global_tokens)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
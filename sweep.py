@@ -0,0 +1,153 @@
+# coding=utf-8
+'''
+Grid search over EDEE hyperparameters in one process tree.
+
+The datasets and the word embedding are loaded once, then trials run in forked worker processes
+that share them copy-on-write (the embedding through shared memory). A trial is stopped early when
+its dev macro F1 after an epoch is below the median of the other trials at the same epoch.
+
+    python sweep.py --hidden_sizes 100 200 --learning_rates 1e-3 5e-4 --num_workers 4
+'''
+import copy
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+import numpy as np
+import torch
+
+from datasets import load_datasets_and_vocabs
+from models import EDEE
+from run import build_parser, set_seed
+from trainer import train, get_macro_f1
+
+logger = logging.getLogger()
+
+SWEEP_PARAMS = [('hidden_size', 'hidden_sizes'), ('num_layers', 'num_layers_list'), ('num_mlps', 'num_mlps_list'),
+                ('dropout', 'dropouts'), ('learning_rate', 'learning_rates')]
+
+# set in the parent before the pool forks, read-only in the trials
+_shared = {}
+
+
+class MedianStopper(object):
+    '''
+    Median stopping rule over the dev macro F1 reported by all trials at the same epoch.
+    '''
+    def __init__(self,epoch_scores,lock,grace_epochs,min_trials):
+        self.epoch_scores = epoch_scores
+        self.lock = lock
+        self.grace_epochs = grace_epochs
+        self.min_trials = min_trials
+
+    def __call__(self,epoch,dev_results):
+        f1 = get_macro_f1(dev_results)
+        with self.lock:
+            others = list(self.epoch_scores.get(epoch, []))
+            self.epoch_scores[epoch] = others + [f1]
+        self.history.append(f1)
+        if epoch < self.grace_epochs or len(others) < self.min_trials:
+            return False
+        if f1 < np.median(others):
+            self.stopped = True
+        return self.stopped
+
+    def start_trial(self):
+        self.history = []
+        self.stopped = False
+
+
+def run_trial(trial):
+    trial_id, params = trial
+    args = copy.copy(_shared['args'])
+    for name, value in params.items():
+        setattr(args, name, value)
+    args.output_dir = os.path.join(args.output_dir, 'trial_{}'.format(trial_id))
+    args.tb_log_dir = os.path.join(args.output_dir, 'runs')
+    torch.set_num_threads(args.threads_per_trial)
+    set_seed(args)
+
+    stopper = _shared['stopper']
+    stopper.start_trial()
+    start = time.time()
+    model = EDEE(args, _shared['wType_tag_num'])
+    model.to(args.device)
+    train(args, model, _shared['train_dataset'], _shared['dev_dataset'], None,
+          _shared['train_labels_weight'], _shared['dev_labels_weight'], None, epoch_callback=stopper)
+
+    best_epoch = int(np.argmax(stopper.history))
+    result = dict(params, trial=trial_id, best_dev_f1=stopper.history[best_epoch], best_epoch=best_epoch + 1,
+                  epochs=len(stopper.history), stopped_early=stopper.stopped, seconds=time.time() - start)
+    logger.info('Trial %d %s: best dev macro f1 %.4f', trial_id, params, result['best_dev_f1'])
+    return result
+
+
+def format_value(column,value):
+    # metrics keep 4 decimals, hyperparameters such as a 5e-5 learning rate are written exactly
+    if column in ['best_dev_f1', 'seconds']:
+        return '{:.4f}'.format(value)
+    if isinstance(value, float):
+        return '{:g}'.format(value)
+    return str(value)
+
+
+def write_results(results,path):
+    columns = ['trial'] + [name for name, _ in SWEEP_PARAMS] + ['best_dev_f1', 'best_epoch', 'epochs', 'stopped_early', 'seconds']
+    results = sorted(results, key=lambda result: result['best_dev_f1'], reverse=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\t'.join(columns) + '\n')
+        for result in results:
+            f.write('\t'.join(format_value(c, result[c]) for c in columns) + '\n')
+    return results
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',level=logging.INFO)
+    parser = build_parser()
+    parser.add_argument('--hidden_sizes', type=int, nargs='+', default=None)
+    parser.add_argument('--num_layers_list', type=int, nargs='+', default=None)
+    parser.add_argument('--num_mlps_list', type=int, nargs='+', default=None)
+    parser.add_argument('--dropouts', type=float, nargs='+', default=None)
+    parser.add_argument('--learning_rates', type=float, nargs='+', default=None)
+    parser.add_argument('--num_workers', type=int, default=2, help='Trials trained in parallel.')
+    parser.add_argument('--threads_per_trial', type=int, default=1, help='torch intra-op threads of every trial.')
+    parser.add_argument('--grace_epochs', type=int, default=2, help='Epochs every trial runs before it can be stopped.')
+    parser.add_argument('--min_trials', type=int, default=2,
+                        help='Scores of other trials needed at an epoch before stopping on it.')
+    args = parser.parse_args()
+    args.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    set_seed(args)
+
+    grid = []
+    for name, list_name in SWEEP_PARAMS:
+        values = getattr(args, list_name)
+        grid.append([(name, value) for value in (values if values else [getattr(args, name)])])
+    trials = list(enumerate(dict(combo) for combo in itertools.product(*grid)))
+    logger.info('Sweeping %d trials with %d workers', len(trials), args.num_workers)
+
+    train_dataset,train_labels_weight,dev_dataset,dev_labels_weight,_,_,_,wType_tag_vocab = load_datasets_and_vocabs(args)
+    # the frozen embedding is the largest tensor, keep one copy for all trials
+    args.token_embedding.share_memory_()
+
+    ctx = multiprocessing.get_context('fork')
+    manager = ctx.Manager()
+    _shared.update(args=args, train_dataset=train_dataset, dev_dataset=dev_dataset,
+                   train_labels_weight=train_labels_weight, dev_labels_weight=dev_labels_weight,
+                   wType_tag_num=wType_tag_vocab['len'],
+                   stopper=MedianStopper(manager.dict(), manager.Lock(), args.grace_epochs, args.min_trials))
+
+    with ctx.Pool(args.num_workers, maxtasksperchild=1) as pool:
+        results = pool.map(run_trial, trials, chunksize=1)
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    results_file = os.path.join(args.output_dir, 'sweep_results.tsv')
+    results = write_results(results, results_file)
+    logger.info('***** Sweep results, written to %s *****', results_file)
+    for result in results:
+        logger.info('  %s', {k: result[k] for k in ['trial', 'best_dev_f1', 'best_epoch', 'stopped_early'] + [name for name, _ in SWEEP_PARAMS]})
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,4 @@
 import random
-import torch.nn.functional as F
 from tensorboardX import SummaryWriter
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from tqdm import trange
@@ -20,6 +19,10 @@ def get_input_from_batch(batch):
                'wType_ids':batch[1],
                 }
     labels = batch[2]
+    if len(batch) > 3:
+        # sentence window mode, only the pairs in pair_ids are scored and trained on
+        inputs['pair_ids'] = batch[3]
+        labels = labels[batch[3]]
 
     return inputs, labels
 
@@ -27,9 +30,64 @@ def get_input_from_batch(batch):
 def get_collate_fn():
     return my_collate
 
-def train(args,model,train_dataset,test_dataset,train_labels_weight,test_labels_weight):
-    '''Train the model'''
-    tb_writer = SummaryWriter()
+def sample_pairs(args,model,token_feature,pair_ids,labels,generator):
+    '''
+    Keep every connected pair and sample args.num_neg_samples non_conn pairs of one document.
+    Returns the sampled pair ids, their labels and the inverse sampling rate of every sampled pair.
+    random: negatives are drawn uniformly.
+    hard: half of the budget goes to the negatives with the lowest non_conn probability among
+    args.hard_candidate_factor*args.num_neg_samples random candidates, which are kept with weight 1,
+    the other half is drawn uniformly from the remaining negatives.
+    '''
+    pos = torch.nonzero(labels > 0).squeeze(1)
+    neg = torch.nonzero(labels == 0).squeeze(1)
+    num_samples = min(args.num_neg_samples, len(neg))
+    sample_weight = torch.ones(len(pos) + num_samples, device=labels.device)
+
+    if args.neg_sampling == 'hard' and num_samples > 1:
+        num_hard = num_samples // 2
+        # scoring every negative would cost a full pass over the pair grid, so hard ones come from a candidate pool
+        num_candidates = min(args.hard_candidate_factor * num_samples, len(neg))
+        candidates = torch.randperm(len(neg), generator=generator)[:num_candidates].to(neg.device)
+        with torch.no_grad():
+            non_conn_scores = model.non_conn_log_probs(model.pair_features(token_feature, pair_ids[neg[candidates]]))
+        hard = candidates[torch.argsort(non_conn_scores)[:num_hard]]
+        is_rest = torch.ones(len(neg), dtype=torch.bool, device=neg.device)
+        is_rest[hard] = False
+        rest = torch.nonzero(is_rest).squeeze(1)
+        picked = torch.randperm(len(rest), generator=generator)[:num_samples - num_hard].to(rest.device)
+        sampled = torch.cat([hard, rest[picked]])
+        sample_weight[len(pos) + num_hard:] = len(rest) / (num_samples - num_hard)
+    else:
+        sampled = torch.randperm(len(neg), generator=generator)[:num_samples].to(neg.device)
+        if num_samples > 0:
+            sample_weight[len(pos):] = len(neg) / num_samples
+
+    selected = torch.cat([pos, neg[sampled]])
+    return pair_ids[selected], labels[selected], sample_weight
+
+def sampled_pair_loss(args,model,inputs,labels,labels_weight,generator):
+    '''
+    Class weighted cross entropy over the sampled pairs. Sampled negatives are upweighted by their inverse
+    sampling rate, so the loss estimates the weighted mean over all pairs of the document.
+    '''
+    token_feature = model.encode(inputs['word_ids'], inputs['wType_ids'])
+    if 'pair_ids' in inputs:
+        pair_ids = inputs['pair_ids']
+    else:
+        pair_ids = torch.arange(token_feature.size(0) ** 2, device=labels.device)
+    pair_ids, labels, sample_weight = sample_pairs(args, model, token_feature, pair_ids, labels, generator)
+    return model.pair_loss(model.pair_features(token_feature, pair_ids), labels, labels_weight, sample_weight)
+
+def train(args,model,train_dataset,dev_dataset,test_dataset,train_labels_weight,dev_labels_weight,test_labels_weight,
+          epoch_callback=None):
+    '''
+    Train the model, evaluating on dev and, unless test_dataset is None, test after every epoch.
+    The state_dict of the epoch with the best dev macro F1 is saved to output_dir/model.pt.
+    epoch_callback(epoch, dev_results) is called after each epoch and stops training by returning True.
+    Returns the dev results of every epoch.
+    '''
+    tb_writer = SummaryWriter(getattr(args, 'tb_log_dir', None))
 
     args.train_batch_size = args.per_gpu_train_batch_size
     train_sampler = RandomSampler(train_dataset)
@@ -65,20 +123,30 @@ def train(args,model,train_dataset,test_dataset,train_labels_weight,test_labels_
     model.zero_grad()
     train_iterator = trange(int(args.num_train_epochs), desc="Epoch")
     set_seed(args)
+    neg_generator = torch.Generator().manual_seed(args.seed)
     epoch = 0
 
-    train_labels_weight = torch.tensor(train_labels_weight).to(args.device)
-    test_labels_weight = torch.tensor(test_labels_weight).to(args.device)
+    train_labels_weight = torch.as_tensor(train_labels_weight).to(args.device)
+    dev_labels_weight = torch.as_tensor(dev_labels_weight).to(args.device)
+    if test_dataset is not None:
+        test_labels_weight = torch.as_tensor(test_labels_weight).to(args.device)
 
-    f = open('./output/result.txt','w',encoding='utf-8')
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    f = open(os.path.join(args.output_dir, 'result.txt'),'w',encoding='utf-8')
+    dev_history = []
+    best_dev_f1 = -1
     for _ in train_iterator:
         for step, batch in enumerate(train_dataloader):
             model.train()
             batch = tuple(t.to(args.device) for t in batch)
             inputs, labels = get_input_from_batch(batch)
-            logits = model(**inputs)
-
-            loss = F.cross_entropy(logits,labels,weight=train_labels_weight)
+            if args.neg_sampling != 'none':
+                loss = sampled_pair_loss(args,model,inputs,labels,train_labels_weight,neg_generator)
+            else:
+                token_feature = model.encode(inputs['word_ids'], inputs['wType_ids'])
+                pair_feature = model.pair_features(token_feature, inputs.get('pair_ids'))
+                loss = model.pair_loss(pair_feature,labels,train_labels_weight)
 
             if args.gradient_accumulation_steps > 1:
                 loss = loss / args.gradient_accumulation_steps
@@ -98,11 +166,25 @@ def train(args,model,train_dataset,test_dataset,train_labels_weight,test_labels_
                     logger.info("  train_loss: %s", str((tr_loss - logging_loss) / args.logging_steps))
                     logging_loss = tr_loss
 
-        results,eval_loss = evaluate(args,test_dataset,model,test_labels_weight,f)
+        results,eval_loss = evaluate(args,dev_dataset,model,dev_labels_weight,f)
+        dev_history.append(results)
+        dev_f1 = get_macro_f1(results)
+        tb_writer.add_scalar('dev_macro_f1', dev_f1, epoch)
+        if dev_f1 > best_dev_f1:
+            best_dev_f1 = dev_f1
+            torch.save(model.state_dict(), os.path.join(args.output_dir, 'model.pt'))
+            logger.info('Saved model of epoch %d (dev macro f1 %.4f) to %s', epoch + 1, dev_f1, args.output_dir)
+        if test_dataset is not None:
+            evaluate(args,test_dataset,model,test_labels_weight,f)
         tb_writer.add_scalar('train_epoch_loss',(tr_loss - logging_loss) / args.logging_steps, epoch)
         epoch += 1
+        if epoch_callback is not None and epoch_callback(epoch, results):
+            logger.info('Stopping training after epoch %d', epoch)
+            break
 
     tb_writer.close()
+    f.close()
+    return dev_history
 
 def evaluate(args, eval_dataset, model,test_labels_weight,f):
     args.eval_batch_size = args.per_gpu_eval_batch_size
@@ -117,22 +199,53 @@ def evaluate(args, eval_dataset, model,test_labels_weight,f):
     nb_eval_steps = 0
     out_label_ids = []
     final_preds = []
+    doc_windows = []
 
-    for batch in eval_dataloader:
+    for step, batch in enumerate(eval_dataloader):
         model.eval()
         batch = tuple(t.to(args.device) for t in batch)
         inputs, labels = get_input_from_batch(batch)
 
-        logits = model(**inputs)
-        loss = F.cross_entropy(logits,labels,weight=test_labels_weight)
+        with torch.no_grad():
+            token_feature = model.encode(inputs['word_ids'], inputs['wType_ids'])
+            pair_feature = model.pair_features(token_feature, inputs.get('pair_ids'))
+            loss = model.pair_loss(pair_feature,labels,test_labels_weight)
+            # the factorized head predicts without the logits of all labels
+            preds, confs = model.predict_pairs(pair_feature)
 
         # tmp_eval_loss = loss
         eval_loss += loss.mean().item()
         nb_eval_steps += 1
 
-        preds = np.argmax(logits.detach().cpu().numpy(), axis=1)
-        final_preds += preds.tolist()
-        out_label_ids += labels.detach().cpu().tolist()
+        preds = preds.cpu().numpy()
+        confs = confs.cpu().numpy()
+        if 'pair_ids' in inputs:
+            # pairs outside the sentence window are never scored and count as non_conn
+            pair_ids = inputs['pair_ids'].cpu().numpy()
+            full_preds = np.zeros(len(batch[2]), dtype=preds.dtype)
+            full_preds[pair_ids] = preds
+            full_confs = np.zeros(len(batch[2]), dtype=confs.dtype)
+            full_confs[pair_ids] = confs
+            preds, confs = full_preds, full_confs
+            labels = batch[2]
+
+        # the eval batch size is 1, so step indexes the example
+        example = eval_dataset.examples[step]
+        if 'doc_id' not in example:
+            final_preds += preds.tolist()
+            out_label_ids += labels.detach().cpu().tolist()
+            continue
+
+        # windows of one document are consecutive, score the document once all of them are merged
+        doc_windows.append((example['word_offsets'], preds, confs))
+        if step + 1 == len(eval_dataset) or eval_dataset.examples[step + 1]['doc_id'] != example['doc_id']:
+            doc_len = example['doc_len']
+            final_preds += merge_window_predictions(doc_len, doc_windows).tolist()
+            doc_labels = np.zeros(doc_len * doc_len, dtype=np.int64)
+            for pair_id, label in example['doc_labels']:
+                doc_labels[pair_id] = label
+            out_label_ids += doc_labels.tolist()
+            doc_windows = []
 
     # preds = np.argmax(preds, axis=1)
 
@@ -150,6 +263,9 @@ def evaluate(args, eval_dataset, model,test_labels_weight,f):
 
     return result,eval_loss
 
+def get_macro_f1(result):
+    return float(np.mean([result[event_type]['f1'] for event_type in idx2event_type.values()]))
+
 def compute_metrics(preds,labels,idx2etype_role_role):
     event_mat = {"EquityFreeze": {"TP": 0, "FP": 0, "TP_FN": 0}, "EquityRepurchase": {"TP": 0, "FP": 0, "TP_FN": 0},
               "EquityUnderweight": {"TP": 0, "FP": 0, "TP_FN": 0}, "EquityOverweight": {"TP": 0, "FP": 0, "TP_FN": 0},